@@ -0,0 +1,267 @@
+"""Нагрузочный прогон бота с локальными заглушками Telegram и CryptoBot.
+
+    python bench.py --updates 5000 --concurrency 16 --tg-latency 0.05
+
+Заглушки поднимаются в этом же процессе, адреса API подменяются через
+TELEGRAM_API_URL / CRYPTOBOT_API до импорта main.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_TOKEN = "bench-token"
+
+# -------------------- Fake APIs --------------------
+class FakeApiConfig:
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+def make_handler(config, respond):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self):
+            config.count()
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            payload = json.loads(raw) if raw else {}
+            url = urlparse(self.path)
+            payload.update({k: v[0] for k, v in parse_qs(url.query).items()})
+            if config.latency:
+                time.sleep(config.latency)
+            roll = random.random()
+            if roll < config.rate_limit_rate:
+                return self._reply(429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                })
+            if roll < config.rate_limit_rate + config.error_rate:
+                return self._reply(500, {"ok": False, "error_code": 500, "description": "Internal"})
+            method = url.path.rsplit("/", 1)[-1]
+            self._reply(200, {"ok": True, "result": respond(method, payload)})
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+_counter = iter(range(1, 10 ** 9))
+
+def telegram_result(method, payload):
+    n = next(_counter)
+    if method == "createChatInviteLink":
+        return {"invite_link": f"https://t.me/+bench{n}"}
+    if method in ("sendMessage", "editMessageText", "sendInvoice"):
+        return {"message_id": n}
+    return True
+
+def cryptobot_result(method, payload, paid_rate):
+    if method == "createInvoice":
+        n = next(_counter)
+        return {"invoice_id": n, "status": "active", "pay_url": f"https://t.me/CryptoBot?start=bench{n}"}
+    if method == "getInvoices":
+        ids = [int(x) for x in str(payload.get("invoice_ids", "")).split(",") if x]
+        return {"items": [
+            {"invoice_id": i, "status": "paid" if random.random() < paid_rate else "active"}
+            for i in ids
+        ]}
+    return {}
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# -------------------- Synthetic updates --------------------
+UPDATE_MIX = [
+    ("start", 30),
+    ("channel_premium", 20),
+    ("my_subs", 10),
+    ("back_main", 10),
+    ("crypto", 10),
+    ("pay_from_balance", 10),
+    ("successful_payment", 10),
+]
+
+def make_update(update_id, kind, user_id):
+    user = {"id": user_id, "username": f"user{user_id}", "first_name": "Bench"}
+    chat = {"id": user_id, "type": "private"}
+    if kind == "start":
+        return {"update_id": update_id, "message": {"message_id": update_id, "from": user, "chat": chat, "text": "/start"}}
+    if kind == "successful_payment":
+        return {"update_id": update_id, "message": {
+            "message_id": update_id,
+            "from": user,
+            "chat": chat,
+            "successful_payment": {
+                "currency": "XTR",
+                "total_amount": 1000,
+                "invoice_payload": "stars_1000",
+                "telegram_payment_charge_id": f"bench-charge-{update_id}",
+            },
+        }}
+    data = kind
+    if kind == "crypto":
+        data = "crypto_" + random.choice(["USDT", "TON", "BTC", "ETH"])
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id),
+        "from": user,
+        "message": {"message_id": 1, "chat": chat},
+        "data": data,
+    }}
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# -------------------- Run --------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8, help="параллельных отправителей вебхуков")
+    parser.add_argument("--tg-latency", type=float, default=0.03)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+    parser.add_argument("--tg-429-rate", type=float, default=0.0)
+    parser.add_argument("--crypto-latency", type=float, default=0.05)
+    parser.add_argument("--crypto-paid-rate", type=float, default=0.2)
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    tg = FakeApiConfig(args.tg_latency, args.tg_error_rate, args.tg_429_rate)
+    crypto = FakeApiConfig(args.crypto_latency)
+    tg_server = start_server(make_handler(tg, telegram_result))
+    crypto_server = start_server(make_handler(
+        crypto, lambda m, p: cryptobot_result(m, p, args.crypto_paid_rate)
+    ))
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "CRYPTOBOT_TOKEN": "bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{tg_server.server_port}",
+        "CRYPTOBOT_API": f"http://127.0.0.1:{crypto_server.server_port}/api",
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "PRICE_SOURCE": "static",
+    })
+    import main as bot
+
+    bot.price_feed.refresh()
+    # Части пользователей хватает звёзд на оплату с баланса
+    for uid in range(1, args.users + 1, 2):
+        bot.update_user_balance(uid, 5000)
+
+    latencies = []
+    submitted = {}
+    accepted = [0]
+    rejected = [0]
+    sending_done = threading.Event()
+    done = threading.Event()
+    lock = threading.Lock()
+    original_handle_update = bot.handle_update
+
+    def timed_handle_update(update):
+        try:
+            original_handle_update(update)
+        finally:
+            finished = time.perf_counter()
+            with lock:
+                started = submitted.pop(update.get("update_id"), None)
+                if started is not None:
+                    latencies.append(finished - started)
+                if len(latencies) >= accepted[0] and sending_done.is_set():
+                    done.set()
+
+    bot.handle_update = timed_handle_update
+    bot.start_services()
+
+    client_url = f"/webhook/{BENCH_TOKEN}"
+    kinds = [k for k, _ in UPDATE_MIX]
+    weights = [w for _, w in UPDATE_MIX]
+    ids = iter(range(1, args.updates + 1))
+
+    def sender():
+        client = bot.app.test_client()
+        while True:
+            with lock:
+                update_id = next(ids, None)
+            if update_id is None:
+                return
+            update = make_update(
+                update_id, random.choices(kinds, weights)[0], random.randint(1, args.users)
+            )
+            with lock:
+                submitted[update_id] = time.perf_counter()
+            status = client.post(client_url, json=update).status_code
+            with lock:
+                if status == 200:
+                    accepted[0] += 1
+                else:
+                    submitted.pop(update_id, None)
+                    rejected[0] += 1
+
+    started = time.perf_counter()
+    senders = [threading.Thread(target=sender) for _ in range(args.concurrency)]
+    for t in senders:
+        t.start()
+    for t in senders:
+        t.join()
+    sending_done.set()
+    with lock:
+        if len(latencies) >= accepted[0]:
+            done.set()
+    done.wait(args.drain_timeout)
+    handled_at = time.perf_counter()
+    while sum(bot.outbound.depth().values()) and time.perf_counter() - handled_at < args.drain_timeout:
+        time.sleep(0.05)
+    drained_at = time.perf_counter()
+
+    elapsed = handled_at - started
+    locked = sum(
+        v for (op, kind), v in bot.db_errors._values.items() if kind == "locked"
+    )
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("-------------------- bench --------------------")
+    print(f"updates sent:        {args.updates} (accepted {accepted[0]}, rejected {rejected[0]})")
+    print(f"updates handled:     {len(latencies)} in {elapsed:.2f}s")
+    print(f"throughput:          {len(latencies) / elapsed:.1f} updates/s")
+    print(f"latency p50 / p99:   {percentile(latencies, 50) * 1000:.1f} / {percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"outbound drained in: {drained_at - started:.2f}s")
+    print(f"telegram requests:   {tg.requests}")
+    print(f"cryptobot requests:  {crypto.requests}")
+    print(f"db lock errors:      {locked}")
+    print(f"peak RSS:            {peak_rss_mb:.1f} MB")
+
+if __name__ == "__main__":
+    main()
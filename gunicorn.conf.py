@@ -0,0 +1,12 @@
+# Запуск в несколько воркеров: gunicorn -c gunicorn.conf.py main:app
+# Вебхуки обслуживают все воркеры, фоновые задачи — только держатель аренды в БД.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+
+def post_worker_init(worker):
+    import main
+
+    main.start_services()
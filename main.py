@@ -1,10 +1,27 @@
+import argparse
+import atexit
+import functools
+import hashlib
+import heapq
+import hmac
+import html
+import itertools
+import json
 import os
+import queue
+import socket
 import threading
 import time
+import uuid
 import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request, jsonify
 
 # -------------------- Настройки --------------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -14,30 +31,361 @@ STARS_PROVIDER_TOKEN = os.getenv("STARS_PROVIDER_TOKEN", "")
 PRIVATE_CHANNEL_ID = "-1003176208290"
 SELF_URL = os.getenv("SELF_URL")
 PORT = int(os.getenv("PORT", "8080"))
+# Способ получения апдейтов: "webhook" (нужен SELF_URL) или "polling" (getUpdates)
+BOT_MODE = os.getenv("BOT_MODE", "webhook")
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))
+
+# Пул обработчиков апдейтов
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Что делать при переполнении очереди: "429" (Telegram повторит позже) или "shed" (отбросить)
+UPDATE_OVERLOAD = os.getenv("UPDATE_OVERLOAD", "429")
+# Дедупликация повторных доставок: сколько последних update_id помнить
+# и как часто сохранять верхнюю отметку в bot_state
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))
+UPDATE_DEDUP_PERSIST = float(os.getenv("UPDATE_DEDUP_PERSIST", "2"))
+REFUSED_UPDATE_TTL = 24 * 3600  # Telegram перестаёт повторять доставку задолго до этого
+# Журнал принятых апдейтов: сколько записей фиксировать одной транзакцией,
+# как часто сбрасывать отметки о выполнении и сколько вебхук ждёт коммита
+JOURNAL_BATCH_SIZE = int(os.getenv("JOURNAL_BATCH_SIZE", "500"))
+JOURNAL_FLUSH_INTERVAL = 0.2
+JOURNAL_COMMIT_TIMEOUT = float(os.getenv("JOURNAL_COMMIT_TIMEOUT", "5"))
+# Сколько хранить отметки о выполненных апдейтах: по ним любой воркер узнаёт повторную доставку
+JOURNAL_KEEP_DONE = float(os.getenv("JOURNAL_KEEP_DONE", "3600"))
+JOURNAL_PRUNE_INTERVAL = 60
+
+# Ответ на нажатие кнопок меню: "edit" — править исходное сообщение, "message" — слать новое
+CALLBACK_MODE = os.getenv("CALLBACK_MODE", "edit")
+
+# Исходящие HTTP-запросы
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+
+# Лимиты Telegram на отправку: ~30 сообщений/с всего и ~1/с в один чат
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_SENDER_THREADS = int(os.getenv("TG_SENDER_THREADS", "4"))
+TG_SEND_WAIT_TIMEOUT = float(os.getenv("TG_SEND_WAIT_TIMEOUT", "30"))
+TG_CHAT_BUCKETS_MAX = 10000
+
+# Рассылки
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "200"))
+
+# Окончание подписок
+SUB_REMINDER_DAYS = int(os.getenv("SUB_REMINDER_DAYS", "3"))  # 0 — без напоминаний
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "100"))
+EXPIRY_MAX_SLEEP = 3600
+
+# Несколько воркеров/реплик: фоновые задачи выполняет только держатель аренды в БД
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+PRICE_SYNC_INTERVAL = 30  # как часто не-лидеры перечитывают курсы из БД
+BROADCAST_LEASE_TTL = 300
+
+# Пул заранее созданных одноразовых ссылок-приглашений (0 — создавать по запросу)
+INVITE_POOL_SIZE = int(os.getenv("INVITE_POOL_SIZE", "20"))
+INVITE_LINK_DAYS = int(os.getenv("INVITE_LINK_DAYS", "30"))
+# Ссылки, которым осталось меньше этого, не выдаются и заменяются новыми
+INVITE_ROTATE_DAYS = int(os.getenv("INVITE_ROTATE_DAYS", "7"))
+INVITE_POOL_CHECK = 300
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
-BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
-CRYPTOBOT_API = "https://pay.crypt.bot/api"
+# Адреса API можно подменить (локальные заглушки в bench.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+BASE_URL = f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}"
+CRYPTOBOT_API = os.getenv("CRYPTOBOT_API", "https://pay.crypt.bot/api")
 
-DB_PATH = "bot_database.db"
+# Проверка крипто-инвойсов
+CRYPTO_BATCH_SIZE = int(os.getenv("CRYPTO_BATCH_SIZE", "100"))
+CRYPTO_CONFIRM_WORKERS = int(os.getenv("CRYPTO_CONFIRM_WORKERS", "4"))
+CRYPTO_POLL_FAST = float(os.getenv("CRYPTO_POLL_FAST", "5"))
+CRYPTO_POLL_SLOW = float(os.getenv("CRYPTO_POLL_SLOW", "30"))
+CRYPTO_FRESH_WINDOW = 600  # инвойс младше 10 минут проверяем чаще
+CRYPTO_INVOICE_TTL = 2 * 3600
+# С вебхуком CryptoBot опрос нужен только для сверки пропущенных уведомлений
+CRYPTOBOT_WEBHOOK = os.getenv("CRYPTOBOT_WEBHOOK", "0") == "1"
+CRYPTO_RECONCILE_INTERVAL = float(os.getenv("CRYPTO_RECONCILE_INTERVAL", "300"))
 
-# Актуальные цены (обновляются в реальном времени)
-crypto_prices = {
-    "BTC": 90000,    # ~$90,000 за BTC (реальная цена)
-    "ETH": 3500,     # ~$3,500 за ETH (реальная цена)
-    "TON": 2.0,      # ~$2.0 за TON
-    "USDT": 1.0
-}
+DB_PATH = os.getenv("DB_PATH", "bot_database.db")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "128"))
+
+# Кэш баланса и подписок пользователей
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+# Изменения из других воркеров приходят через таблицу cache_invalidations
+USER_CACHE_SYNC_INTERVAL = float(os.getenv("USER_CACHE_SYNC_INTERVAL", "1"))
+CACHE_INVALIDATION_KEEP = 600
+# Профили (username, first_name) пишутся в БД пачками раз в PROFILE_FLUSH_INTERVAL секунд
+PROFILE_FLUSH_INTERVAL = float(os.getenv("PROFILE_FLUSH_INTERVAL", "5"))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "50000"))
+
+# Курсы криптовалют
+PRICE_SOURCE = os.getenv("PRICE_SOURCE", "coingecko")  # "static" — фиксированные цены для тестов
+PRICE_REFRESH_INTERVAL = float(os.getenv("PRICE_REFRESH_INTERVAL", "300"))
+PRICE_MAX_AGE = float(os.getenv("PRICE_MAX_AGE", "1800"))  # старше — инвойсы не создаём
+PRICE_RETRY_MIN = 10
+# Кэш ожидающих оплаты инвойсов; источник истины — таблица pending_invoices.
+# Заполняет только лидер (crypto_checker_loop), остальные воркеры его не трогают.
 active_crypto_invoices = {}
 
+# -------------------- Metrics --------------------
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(labelnames, values, extra=""):
+    parts = [f'{n}="{v}"' for n, v in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [счётчики по бакетам..., сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for labels, data in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {data[-1]}")
+        return lines
+
+class Gauge:
+    """Значение считается в момент запроса /metrics"""
+
+    def __init__(self, name, help_text, func, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.labelnames = labelnames
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.func()
+        except Exception as e:
+            print(f"metric {self.name} error", e)
+            return lines
+        if isinstance(value, dict):
+            for labels, v in sorted(value.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, (labels,))} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+METRICS = []
+
+def register_metric(metric):
+    METRICS.append(metric)
+    return metric
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+http_seconds = register_metric(Histogram(
+    "bot_http_request_seconds", "Outbound HTTP call latency", ("service", "endpoint")
+))
+http_errors = register_metric(Counter(
+    "bot_http_errors_total", "Outbound HTTP calls failed or answered with status >= 400", ("service", "endpoint")
+))
+db_seconds = register_metric(Histogram("bot_db_seconds", "DB helper latency", ("op",)))
+db_errors = register_metric(Counter("bot_db_errors_total", "DB helper errors", ("op", "error")))
+update_seconds = register_metric(Histogram("bot_update_seconds", "Update handling time", ("kind",)))
+callback_seconds = register_metric(Histogram("bot_callback_seconds", "Callback handling time", ("action",)))
+handler_errors = register_metric(Counter("bot_handler_errors_total", "Unhandled errors in update handlers", ("kind",)))
+
+def db_timed(fn):
+    """Время и ошибки DB-хелпера, метка — имя функции"""
+    labels = (fn.__name__,)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except sqlite3.Error as e:
+            # "database is locked" выделяем отдельно — это главный признак конкуренции за запись
+            kind = "locked" if "locked" in str(e) else type(e).__name__
+            db_errors.inc((fn.__name__, kind))
+            raise
+        finally:
+            db_seconds.observe(labels, time.perf_counter() - start)
+    return wrapper
+
+# -------------------- HTTP --------------------
+def make_http_session():
+    """Сессия с keep-alive пулом соединений к одному хосту"""
+    # Повторяем только ошибки соединения и GET: POST может быть уже выполнен
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+http_sessions = {
+    "telegram": make_http_session(),
+    "cryptobot": make_http_session(),
+    "coingecko": make_http_session(),
+}
+
+def http_request(service, method, url, **kwargs):
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    labels = (service, url.rsplit("/", 1)[-1].split("?")[0])
+    start = time.perf_counter()
+    try:
+        response = http_sessions[service].request(method, url, **kwargs)
+    except Exception:
+        http_errors.inc(labels)
+        raise
+    finally:
+        http_seconds.observe(labels, time.perf_counter() - start)
+    if response.status_code >= 400:
+        http_errors.inc(labels)
+    return response
+
+def http_get(service, url, **kwargs):
+    return http_request(service, "GET", url, **kwargs)
+
+def http_post(service, url, **kwargs):
+    return http_request(service, "POST", url, **kwargs)
+
 # -------------------- Flask --------------------
 app = Flask(__name__)
 
 # -------------------- DB --------------------
+_db_local = threading.local()
+
+def get_db():
+    """Соединение текущего потока: открывается один раз и переиспользуется
+    вместе с кэшем подготовленных выражений"""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(
+            DB_PATH,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        _db_local.conn = conn
+    return conn
+
+@contextmanager
+def db_transaction():
+    """Транзакция на соединении потока. Вложенные вызовы выполняются
+    внутри внешней транзакции."""
+    conn = get_db()
+    if conn.in_transaction:
+        yield conn.cursor()
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+        conn.execute("COMMIT")
+    except BaseException:
+        _abort_transaction(conn)
+        raise
+
+def _abort_transaction(conn):
+    """ROLLBACK без подмены исходной ошибки. Если соединение так и осталось
+    в транзакции, закрываем его: иначе поток навсегда застрянет во «вложенной»
+    ветке db_transaction и будет держать блокировку записи."""
+    try:
+        conn.execute("ROLLBACK")
+    except sqlite3.Error as e:
+        print("rollback failed:", e)
+    if conn.in_transaction:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        if getattr(_db_local, "conn", None) is conn:
+            _db_local.conn = None
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    migrate_db()
+    for problem in check_query_plans():
+        print(f"⚠️ {problem}")
+
+def migrate_db():
+    """Применяет миграции по порядку; номер версии хранится в PRAGMA user_version"""
+    while True:
+        with db_transaction() as c:
+            # Версию читаем под блокировкой записи, чтобы параллельный процесс не применил миграцию дважды
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                return
+            MIGRATIONS[version](c)
+            c.execute(f"PRAGMA user_version={version + 1}")
+        print(f"🗄 DB migrated to version {version + 1}")
+
+def _migration_1_base_schema(c):
+    # Схема до появления миграций: на существующих базах только досоздаёт недостающее
     c.execute(
         """CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, balance INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
     )
@@ -50,8 +398,231 @@ def init_db():
     c.execute(
         """CREATE TABLE IF NOT EXISTS invite_links (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, invite_link TEXT UNIQUE, expires_at TIMESTAMP, used BOOLEAN DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
     )
-    conn.commit()
-    conn.close()
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS pending_invoices (invoice_id INTEGER PRIMARY KEY, user_id INTEGER, chat_id INTEGER, duration_days INTEGER, status TEXT DEFAULT 'pending', created_at REAL)"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_pending_invoices_status_created ON pending_invoices (status, created_at)"""
+    )
+    _ensure_column(c, "users", "blocked_at", "TIMESTAMP")
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS broadcasts (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT, status TEXT DEFAULT 'running', last_user_id INTEGER DEFAULT 0, sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, finished_at TIMESTAMP)"""
+    )
+    _ensure_column(c, "subscriptions", "reminded_at", "TIMESTAMP")
+    _ensure_column(c, "subscriptions", "ended_at", "TIMESTAMP")
+    _ensure_column(c, "invite_links", "revoked_at", "TIMESTAMP")
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_subscriptions_open_expires ON subscriptions (expires_at) WHERE ended_at IS NULL"""
+    )
+
+def _migration_2_hot_indexes(c):
+    # Покрывающий индекс для get_user_subscriptions: таблица не читается вовсе
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_subscriptions_user_expires ON subscriptions (user_id, expires_at, channel_type)"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_at)"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_invite_links_user ON invite_links (user_id, revoked_at)"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_invite_links_expires ON invite_links (expires_at)"""
+    )
+
+def _migration_3_bot_state(c):
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value TEXT)"""
+    )
+
+def _migration_4_leases(c):
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)"""
+    )
+
+def _migration_5_payment_charge_ids(c):
+    # Ключ идемпотентности платежа: telegram_payment_charge_id или callback:<id> покупки с баланса
+    _ensure_column(c, "transactions", "charge_id", "TEXT")
+    c.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_charge ON transactions (charge_id) WHERE charge_id IS NOT NULL"""
+    )
+
+def _migration_6_invite_pool(c):
+    # Ссылки пула лежат в invite_links с user_id NULL до выдачи
+    _ensure_column(c, "invite_links", "assigned_at", "TIMESTAMP")
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_invite_links_pool ON invite_links (expires_at) WHERE user_id IS NULL AND revoked_at IS NULL"""
+    )
+
+def _migration_7_update_journal(c):
+    # owner — INSTANCE_ID процесса, который принял апдейт
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS update_journal (update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, owner TEXT, received_at REAL)"""
+    )
+
+def _migration_8_stats_rollups(c):
+    # Счётчики по дням (UTC) и текущие итоги; обновляются в тех же транзакциях, что и данные
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS stats_daily (day TEXT, metric TEXT, count INTEGER DEFAULT 0, amount REAL DEFAULT 0, PRIMARY KEY (day, metric))"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS stats_totals (metric TEXT PRIMARY KEY, value INTEGER DEFAULT 0)"""
+    )
+    _ensure_column(c, "subscriptions", "method", "TEXT")
+    _ensure_column(c, "pending_invoices", "price_usd", "REAL")
+    # Пользователей вставляют несколько upsert-ов; триггер срабатывает только на настоящую вставку
+    c.execute(
+        """CREATE TRIGGER IF NOT EXISTS trg_users_new_stat AFTER INSERT ON users BEGIN INSERT INTO stats_daily (day, metric, count) VALUES (date('now'), 'user:new', 1) ON CONFLICT(day, metric) DO UPDATE SET count=count+1; END"""
+    )
+    # Итог ведётся инкрементально, поэтому стартовое значение берём из уже открытых подписок
+    c.execute(
+        """INSERT OR REPLACE INTO stats_totals (metric, value) SELECT 'active_subscribers', COUNT(DISTINCT user_id) FROM subscriptions WHERE ended_at IS NULL"""
+    )
+
+def _migration_9_refused_updates(c):
+    # Апдейты, которым вебхук ответил 429: общие для всех воркеров и переживают рестарт
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS refused_updates (update_id INTEGER PRIMARY KEY, refused_at REAL)"""
+    )
+
+def _migration_10_journal_tombstones(c):
+    # Выполненные апдейты остаются в журнале с done_at: первичный ключ — общая для воркеров дедупликация
+    _ensure_column(c, "update_journal", "done_at", "REAL")
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_update_journal_open ON update_journal (update_id) WHERE done_at IS NULL"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_update_journal_done ON update_journal (done_at) WHERE done_at IS NOT NULL"""
+    )
+
+def _migration_11_source_keys(c):
+    # Ключ апдейта, породившего запись: повтор из журнала не создаст вторую рассылку или второй счёт
+    _ensure_column(c, "broadcasts", "source_key", "TEXT")
+    c.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcasts_source ON broadcasts (source_key) WHERE source_key IS NOT NULL"""
+    )
+    _ensure_column(c, "pending_invoices", "source_key", "TEXT")
+    _ensure_column(c, "pending_invoices", "pay_url", "TEXT")
+    c.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_invoices_source ON pending_invoices (source_key) WHERE source_key IS NOT NULL"""
+    )
+
+def _migration_12_invite_deliveries(c):
+    # Оплатившие, кому не удалось выдать ссылку сразу: её пришлёт invite_pool_loop
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS invite_deliveries (user_id INTEGER PRIMARY KEY, duration_days INTEGER, created_at REAL)"""
+    )
+
+def _migration_13_cache_invalidations(c):
+    # Журнал изменений баланса и подписок: по нему каждый воркер чистит свой user_cache
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS cache_invalidations (seq INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, created_at REAL)"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_cache_invalidations_created ON cache_invalidations (created_at)"""
+    )
+
+MIGRATIONS = [
+    _migration_1_base_schema,
+    _migration_2_hot_indexes,
+    _migration_3_bot_state,
+    _migration_4_leases,
+    _migration_5_payment_charge_ids,
+    _migration_6_invite_pool,
+    _migration_7_update_journal,
+    _migration_8_stats_rollups,
+    _migration_9_refused_updates,
+    _migration_10_journal_tombstones,
+    _migration_11_source_keys,
+    _migration_12_invite_deliveries,
+    _migration_13_cache_invalidations,
+]
+
+def _ensure_column(c, table, column, decl):
+    columns = [row[1] for row in c.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in columns:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+# Горячие запросы, которые не должны делать полный проход по таблице
+HOT_QUERIES = [
+    ("user balance", "SELECT balance FROM users WHERE user_id=?", (1,)),
+    (
+        "active subscriptions",
+        "SELECT channel_type, expires_at FROM subscriptions WHERE user_id=? AND expires_at>datetime('now') ORDER BY expires_at DESC",
+        (1,),
+    ),
+    (
+        "next expiry",
+        "SELECT MIN(expires_at) FROM subscriptions WHERE ended_at IS NULL",
+        (),
+    ),
+    (
+        "due subscriptions",
+        "SELECT id, user_id FROM subscriptions WHERE ended_at IS NULL AND expires_at<=? ORDER BY expires_at LIMIT ?",
+        ("2000-01-01", 1),
+    ),
+    (
+        "user transactions",
+        "SELECT type, amount FROM transactions WHERE user_id=? ORDER BY created_at DESC",
+        (1,),
+    ),
+    (
+        "user invite links",
+        "SELECT id, invite_link FROM invite_links WHERE user_id IN (?) AND revoked_at IS NULL",
+        (1,),
+    ),
+    (
+        "pooled invite link",
+        "SELECT id, invite_link FROM invite_links INDEXED BY idx_invite_links_pool WHERE user_id IS NULL AND revoked_at IS NULL AND expires_at>? ORDER BY expires_at LIMIT 1",
+        ("2000-01-01",),
+    ),
+    (
+        "journal orphans",
+        "SELECT update_id, payload FROM update_journal WHERE update_id>? AND done_at IS NULL AND NOT EXISTS (SELECT 1 FROM leases WHERE name='instance:' || update_journal.owner AND expires_at>?) ORDER BY update_id LIMIT ?",
+        (0, 0, 1),
+    ),
+    (
+        "journal prune",
+        "DELETE FROM update_journal WHERE done_at<?",
+        (0,),
+    ),
+    (
+        "pending invoices count",
+        "SELECT COUNT(*) FROM pending_invoices WHERE status='pending'",
+        (),
+    ),
+    (
+        "expired invoices",
+        "SELECT invoice_id FROM pending_invoices WHERE status='pending' AND created_at<?",
+        (0,),
+    ),
+    (
+        "cache invalidations",
+        "SELECT seq, user_id FROM cache_invalidations WHERE seq>? ORDER BY seq",
+        (0,),
+    ),
+    (
+        "cache invalidations prune",
+        "DELETE FROM cache_invalidations WHERE created_at<?",
+        (0,),
+    ),
+    (
+        "broadcast batch",
+        "SELECT user_id FROM users WHERE user_id>? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+        (0, 1),
+    ),
+]
+
+def check_query_plans():
+    """EXPLAIN QUERY PLAN для HOT_QUERIES: список запросов, которые сканируют таблицу"""
+    problems = []
+    db = get_db()
+    for name, sql, params in HOT_QUERIES:
+        for row in db.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall():
+            detail = row[3]
+            if detail.startswith("SCAN") or "TEMP B-TREE" in detail:
+                problems.append(f"{name}: {detail}")
+    return problems
 
 init_db()
 
@@ -73,14 +644,179 @@ CHANNELS = {
 }
 
 # -------------------- Telegram API --------------------
-def tg_post(method, payload):
+def tg_post(method, payload, timeout=None):
+    kwargs = {"json": payload}
+    if timeout is not None:
+        kwargs["timeout"] = timeout
     try:
-        return requests.post(f"{BASE_URL}/{method}", json=payload, timeout=10).json()
+        return http_post("telegram", f"{BASE_URL}/{method}", **kwargs).json()
     except Exception as e:
         print("tg_post error", e)
         return None
 
-def send_message(chat_id, text, reply_markup=None):
+# -------------------- Outbound queue --------------------
+# Чем меньше число, тем раньше уходит запрос
+PRIORITY_CALLBACK = 0
+PRIORITY_MESSAGE = 1
+PRIORITY_BULK = 2
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now):
+        """Через сколько секунд можно отправить (0 — сразу)"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        self.paused_until = now + seconds
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    def idle(self, now):
+        return now >= self.paused_until and self.delay(now) == 0 and self.tokens >= self.burst
+
+class OutgoingRequest:
+    __slots__ = ("priority", "seq", "method", "payload", "chat_id", "future")
+
+    def __init__(self, priority, seq, method, payload, chat_id):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.payload = payload
+        self.chat_id = chat_id
+        self.future = Future()
+
+class OutboundQueue:
+    """Очередь исходящих запросов к Telegram с общим и поканальным
+    token bucket. Ответ 429 не теряет запрос: он откладывается на retry_after."""
+
+    def __init__(self, global_rate, chat_rate, chat_burst, senders):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.senders = max(1, senders)
+        self.in_progress = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []  # (priority, seq, request)
+        self._delayed = []  # (not_before, seq, request)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._started = False
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.senders):
+            threading.Thread(
+                target=self._sender, name=f"tg-sender-{i}", daemon=True
+            ).start()
+
+    def submit(self, method, payload, chat_id=None, priority=PRIORITY_MESSAGE):
+        if not self._started:
+            self.start()
+        req = OutgoingRequest(priority, next(self._seq), method, payload, chat_id)
+        with self._cond:
+            heapq.heappush(self._ready, (priority, req.seq, req))
+            self._cond.notify()
+        return req.future
+
+    def depth(self):
+        with self._cond:
+            counts = {"callback": 0, "message": 0, "bulk": 0}
+            names = {PRIORITY_CALLBACK: "callback", PRIORITY_MESSAGE: "message", PRIORITY_BULK: "bulk"}
+            for prio, _, _ in self._ready:
+                counts[names.get(prio, "bulk")] += 1
+            counts["delayed"] = len(self._delayed)
+            counts["in_progress"] = self.in_progress
+            return counts
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= TG_CHAT_BUCKETS_MAX:
+                # Полные бакеты ничем не отличаются от новых — их можно забыть
+                for cid in [cid for cid, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[cid]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, req = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (req.priority, seq, req))
+                wait = None
+                if self._ready:
+                    wait = self._global.delay(now)
+                    if wait == 0:
+                        _, seq, req = heapq.heappop(self._ready)
+                        if req.chat_id is not None:
+                            bucket = self._chat_bucket(req.chat_id, now)
+                            chat_wait = bucket.delay(now)
+                            if chat_wait > 0:
+                                # Чат исчерпал лимит — остальные чаты не ждут
+                                heapq.heappush(self._delayed, (now + chat_wait, seq, req))
+                                continue
+                            bucket.take()
+                        self._global.take()
+                        self.in_progress += 1
+                        return req
+                if self._delayed:
+                    until_delayed = self._delayed[0][0] - now
+                    wait = until_delayed if wait is None else min(wait, until_delayed)
+                self._cond.wait(wait)
+
+    def _sender(self):
+        while True:
+            req = self._next()
+            res = tg_post(req.method, req.payload)
+            with self._cond:
+                self.in_progress -= 1
+                if res and res.get("error_code") == 429:
+                    retry_after = res.get("parameters", {}).get("retry_after", 1)
+                    now = time.monotonic()
+                    if req.chat_id is not None:
+                        self._chat_bucket(req.chat_id, now).pause(retry_after, now)
+                    else:
+                        self._global.pause(retry_after, now)
+                    heapq.heappush(self._delayed, (now + retry_after, req.seq, req))
+                    self._cond.notify()
+                    print(f"429 on {req.method}, retry after {retry_after}s")
+                    continue
+            req.future.set_result(res)
+
+outbound = OutboundQueue(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_SENDER_THREADS)
+
+def tg_send(method, payload, chat_id=None, priority=PRIORITY_MESSAGE):
+    """Ставит запрос в очередь отправки и возвращает Future с ответом Telegram"""
+    return outbound.submit(method, payload, chat_id, priority)
+
+def wait_result(future, timeout=TG_SEND_WAIT_TIMEOUT):
+    try:
+        return future.result(timeout=timeout)
+    except Exception as e:
+        print("tg_send wait error", e)
+        return None
+
+def send_message(chat_id, text, reply_markup=None, priority=PRIORITY_MESSAGE):
     data = {
         "chat_id": chat_id,
         "text": text,
@@ -89,13 +825,41 @@ def send_message(chat_id, text, reply_markup=None):
     }
     if reply_markup:
         data["reply_markup"] = reply_markup
-    return tg_post("sendMessage", data)
+    return tg_send("sendMessage", data, chat_id, priority)
+
+def edit_message(chat_id, message_id, text, reply_markup=None):
+    """Правит сообщение с кнопками на месте. Если править нельзя (старое или
+    удалённое сообщение), отправляет новое; "message is not modified" — не ошибка."""
+    if not message_id:
+        return send_message(chat_id, text, reply_markup)
+    data = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "parse_mode": "HTML",
+        "disable_web_page_preview": True,
+    }
+    if reply_markup:
+        data["reply_markup"] = reply_markup
+
+    def fallback(future):
+        res = future.result()
+        if res and res.get("ok"):
+            return
+        # None — сетевая ошибка: меню всё равно нужно показать
+        if res and "message is not modified" in res.get("description", ""):
+            return
+        send_message(chat_id, text, reply_markup)
+
+    future = tg_send("editMessageText", data, chat_id)
+    future.add_done_callback(fallback)
+    return future
 
 def answer_callback_query(callback_id, text=None, show_alert=False):
     data = {"callback_query_id": callback_id, "show_alert": show_alert}
     if text:
         data["text"] = text
-    return tg_post("answerCallbackQuery", data)
+    return tg_send("answerCallbackQuery", data, priority=PRIORITY_CALLBACK)
 
 def send_stars_invoice(chat_id, stars_amount, description):
     data = {
@@ -108,107 +872,697 @@ def send_stars_invoice(chat_id, stars_amount, description):
         "prices": [{"label": "Stars", "amount": stars_amount}],
         "start_parameter": "stars",
     }
-    return tg_post("sendInvoice", data)
+    return wait_result(tg_send("sendInvoice", data, chat_id))
 
 def answer_pre_checkout_query(pre_checkout_query_id):
-    return tg_post(
+    # На pre_checkout у Telegram всего 10 секунд — отвечаем вне очереди сообщений
+    return tg_send(
         "answerPreCheckoutQuery",
         {"pre_checkout_query_id": pre_checkout_query_id, "ok": True},
+        priority=PRIORITY_CALLBACK,
     )
 
+# -------------------- User cache --------------------
+_MISSING = object()
+
+class UserStateCache:
+    """LRU с TTL для состояния пользователя (баланс, список подписок).
+    Запись в БД инвалидирует поле; значение, прочитанное до инвалидации,
+    в кэш уже не попадёт."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id, field):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None and field in entry and entry[field][1] > now:
+                self._data.move_to_end(user_id)
+                self.hits += 1
+                return entry[field][0]
+            self.misses += 1
+            return _MISSING
+
+    def generation(self):
+        return self._generation
+
+    def set(self, user_id, field, value, generation, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            if generation != self._generation:
+                return
+            entry = self._data.setdefault(user_id, {})
+            entry[field] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id, field=None):
+        with self._lock:
+            self._generation += 1
+            entry = self._data.get(user_id)
+            if entry is None:
+                return
+            if field is None:
+                del self._data[user_id]
+            else:
+                entry.pop(field, None)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+user_cache = UserStateCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def _note_user_change(c, user_id):
+    """Вызывается в транзакции, меняющей баланс или подписки: остальные
+    воркеры увидят запись и сбросят свой кэш этого пользователя"""
+    c.execute(
+        "INSERT INTO cache_invalidations (user_id, created_at) VALUES (?, ?)",
+        (user_id, time.time()),
+    )
+
+class UserCacheSync:
+    """Дочитывает cache_invalidations с последнего seq и сбрасывает
+    затронутых пользователей в локальном user_cache"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._seq = get_db().execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM cache_invalidations"
+        ).fetchone()[0]
+        self._pruned_at = time.time()
+
+    @db_timed
+    def poll(self):
+        rows = get_db().execute(
+            "SELECT seq, user_id FROM cache_invalidations WHERE seq>? ORDER BY seq",
+            (self._seq,),
+        ).fetchall()
+        for _, user_id in rows:
+            self.cache.invalidate(user_id)
+        if rows:
+            self._seq = rows[-1][0]
+        return len(rows)
+
+    @db_timed
+    def prune(self):
+        with db_transaction() as c:
+            c.execute(
+                "DELETE FROM cache_invalidations WHERE created_at<?",
+                (time.time() - CACHE_INVALIDATION_KEEP,),
+            )
+
+    def loop(self):
+        while True:
+            time.sleep(USER_CACHE_SYNC_INTERVAL)
+            try:
+                self.poll()
+                # Чистит только лидер; записи живут дольше интервала опроса с запасом
+                if jobs_lease.held() and time.time() - self._pruned_at > CACHE_INVALIDATION_KEEP:
+                    self.prune()
+                    self._pruned_at = time.time()
+            except Exception as e:
+                print("Error syncing user cache:", e)
+
+user_cache_sync = UserCacheSync(user_cache)
+
+# -------------------- Profile sync --------------------
+class ProfileSync:
+    """Отложенная запись профилей: в БД попадают только изменившиеся
+    username/first_name, одной транзакцией на пачку. Заодно снимает
+    blocked_at со всех, кто написал боту с прошлого flush — независимо
+    от кэша профилей: пометку мог поставить рассылкой другой воркер."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._known = OrderedDict()  # user_id -> профиль, совпадающий с БД
+        self._dirty = {}
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def touch(self, user_id, username, first_name):
+        profile = (username or "", first_name or "")
+        with self._lock:
+            self._active.add(user_id)
+            if self._known.get(user_id) == profile:
+                self._known.move_to_end(user_id)
+                return
+            self._dirty[user_id] = profile
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            active, self._active = self._active, set()
+        if not dirty and not active:
+            return 0
+        try:
+            with db_transaction() as c:
+                c.executemany(
+                    """INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name, blocked_at=NULL""",
+                    [(uid, p[0], p[1]) for uid, p in dirty.items()],
+                )
+                c.executemany(
+                    "UPDATE users SET blocked_at=NULL WHERE user_id=? AND blocked_at IS NOT NULL",
+                    [(uid,) for uid in active if uid not in dirty],
+                )
+        except sqlite3.Error:
+            with self._lock:
+                for uid, profile in dirty.items():
+                    self._dirty.setdefault(uid, profile)
+                self._active |= active
+            raise
+        with self._lock:
+            for uid, profile in dirty.items():
+                self._known[uid] = profile
+                self._known.move_to_end(uid)
+            while len(self._known) > self.maxsize:
+                self._known.popitem(last=False)
+        return len(dirty)
+
+    def loop(self):
+        while True:
+            time.sleep(PROFILE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print("Error flushing profiles:", e)
+
+profile_sync = ProfileSync(PROFILE_CACHE_SIZE)
+atexit.register(profile_sync.flush)
+
 # -------------------- DB helpers --------------------
+def _parse_db_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+@db_timed
 def get_user_balance(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
-    res = c.fetchone()
-    conn.close()
-    return res[0] if res else 0
+    bal = user_cache.get(user_id, "balance")
+    if bal is not _MISSING:
+        return bal
+    generation = user_cache.generation()
+    res = get_db().execute(
+        "SELECT balance FROM users WHERE user_id=?", (user_id,)
+    ).fetchone()
+    bal = res[0] if res else 0
+    user_cache.set(user_id, "balance", bal, generation)
+    return bal
+
+@db_timed
+def update_user_balance(user_id, amount):
+    # Меняем только баланс: профиль и created_at остаются как есть
+    with db_transaction() as c:
+        c.execute(
+            """INSERT INTO users (user_id, balance) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET balance=balance+excluded.balance""",
+            (user_id, amount),
+        )
+        if amount:
+            _note_user_change(c, user_id)
+    if amount:
+        user_cache.invalidate(user_id, "balance")
 
-def update_user_balance(user_id, amount, username="", first_name=""):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def _bump_stat(c, metric, amount=0, count=1):
     c.execute(
-        """INSERT OR REPLACE INTO users (user_id, username, first_name, balance) VALUES (?, ?, ?, COALESCE((SELECT balance FROM users WHERE user_id= ?),0)+?)""",
-        (user_id, username, first_name, user_id, amount),
+        "INSERT INTO stats_daily (day, metric, count, amount) VALUES (date('now'), ?, ?, ?) ON CONFLICT(day, metric) DO UPDATE SET count=count+excluded.count, amount=amount+excluded.amount",
+        (metric, count, amount),
     )
-    conn.commit()
-    conn.close()
 
-def add_transaction(user_id, ttype, amount, description):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def _bump_total(c, metric, delta):
     c.execute(
-        "INSERT INTO transactions (user_id,type,amount,description) VALUES (?,?,?,?)",
-        (user_id, ttype, amount, description),
+        "INSERT INTO stats_totals (metric, value) VALUES (?, ?) ON CONFLICT(metric) DO UPDATE SET value=value+excluded.value",
+        (metric, delta),
     )
-    conn.commit()
-    conn.close()
 
-def create_user_subscription(user_id, channel_type, duration_days=30):
+def _insert_transaction(c, user_id, ttype, amount, description, charge_id=None):
+    c.execute(
+        "INSERT INTO transactions (user_id,type,amount,description,charge_id) VALUES (?,?,?,?,?)",
+        (user_id, ttype, amount, description, charge_id),
+    )
+    _bump_stat(c, f"tx:{ttype}", amount)
+
+def _insert_subscription(c, user_id, channel_type, duration_days, method):
     expires_at = datetime.now() + timedelta(days=duration_days)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    # Подписчик — пользователь хотя бы с одной незавершённой подпиской
+    had_open = c.execute(
+        "SELECT 1 FROM subscriptions WHERE user_id=? AND ended_at IS NULL LIMIT 1", (user_id,)
+    ).fetchone()
     c.execute(
-        "INSERT INTO subscriptions (user_id, channel_type, expires_at) VALUES (?,?,?)",
-        (user_id, channel_type, expires_at),
+        "INSERT INTO subscriptions (user_id, channel_type, expires_at, method) VALUES (?,?,?,?)",
+        (user_id, channel_type, expires_at, method),
     )
-    conn.commit()
-    conn.close()
+    _bump_stat(c, f"sub:{method}")
+    if not had_open:
+        _bump_total(c, "active_subscribers", 1)
     return expires_at
 
+@db_timed
+def bump_stat(metric, amount=0):
+    with db_transaction() as c:
+        _bump_stat(c, metric, amount)
+
+# purchase_subscription: покупка с этим ключом уже проведена
+ALREADY_APPLIED = object()
+
+@db_timed
+def purchase_subscription(user_id, channel_type, price, duration_days, description, charge_id=None):
+    """Покупка с баланса одной транзакцией: условное списание, запись
+    в transactions и подписка. None — если звёзд не хватает, ALREADY_APPLIED —
+    если покупка с таким charge_id уже была (повтор апдейта из журнала)."""
+    with db_transaction() as c:
+        # BEGIN IMMEDIATE держит блокировку записи, так что проверка и вставка не разойдутся
+        if charge_id and c.execute(
+            "SELECT 1 FROM transactions WHERE charge_id=?", (charge_id,)
+        ).fetchone():
+            return ALREADY_APPLIED
+        # Условие на balance исключает двойное списание при повторном нажатии
+        c.execute(
+            "UPDATE users SET balance=balance-? WHERE user_id=? AND balance>=?",
+            (price, user_id, price),
+        )
+        if c.rowcount != 1:
+            return None
+        _insert_transaction(c, user_id, "subscription", -price, description, charge_id)
+        expires_at = _insert_subscription(c, user_id, channel_type, duration_days, "balance")
+        new_balance = c.execute(
+            "SELECT balance FROM users WHERE user_id=?", (user_id,)
+        ).fetchone()[0]
+        _note_user_change(c, user_id)
+    user_cache.invalidate(user_id)
+    expiry_wakeup.set()
+    return new_balance, expires_at
+
+@db_timed
+def credit_stars_payment(user_id, amount, charge_id, description):
+    """Зачисление оплаты Stars. Повтор с тем же charge_id ничего не меняет
+    и возвращает None, иначе — новый баланс."""
+    with db_transaction() as c:
+        c.execute(
+            "INSERT OR IGNORE INTO transactions (user_id,type,amount,description,charge_id) VALUES (?,?,?,?,?)",
+            (user_id, "deposit", amount, description, charge_id),
+        )
+        if c.rowcount != 1:
+            return None
+        _bump_stat(c, "tx:deposit", amount)
+        _bump_stat(c, "paid:stars", amount)
+        c.execute(
+            """INSERT INTO users (user_id, balance) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET balance=balance+excluded.balance""",
+            (user_id, amount),
+        )
+        new_balance = c.execute(
+            "SELECT balance FROM users WHERE user_id=?", (user_id,)
+        ).fetchone()[0]
+        _note_user_change(c, user_id)
+    user_cache.invalidate(user_id, "balance")
+    return new_balance
+
+@db_timed
 def save_invite_link(user_id, invite_link, expires_at):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO invite_links (user_id, invite_link, expires_at) VALUES (?,?,?)",
-        (user_id, invite_link, expires_at),
-    )
-    conn.commit()
-    conn.close()
+    with db_transaction() as c:
+        c.execute(
+            "INSERT INTO invite_links (user_id, invite_link, expires_at) VALUES (?,?,?)",
+            (user_id, invite_link, expires_at),
+        )
 
+@db_timed
+def get_state(key, default=None):
+    row = get_db().execute("SELECT value FROM bot_state WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+@db_timed
+def set_state(key, value):
+    with db_transaction() as c:
+        c.execute(
+            "INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (key, str(value)),
+        )
+
+@db_timed
+def load_refused_updates():
+    return {row[0] for row in get_db().execute("SELECT update_id FROM refused_updates")}
+
+@db_timed
+def record_refused_update(update_id):
+    with db_transaction() as c:
+        c.execute(
+            "INSERT OR REPLACE INTO refused_updates (update_id, refused_at) VALUES (?, ?)",
+            (update_id, time.time()),
+        )
+
+@db_timed
+def save_update_dedup_state(mark, redelivered):
+    """Двигает общую верхнюю отметку только вперёд и чистит refused_updates"""
+    with db_transaction() as c:
+        if mark:
+            c.execute(
+                "INSERT INTO bot_state (key, value) VALUES ('update_high_water', ?) ON CONFLICT(key) DO UPDATE SET value=MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                (mark,),
+            )
+        c.executemany(
+            "DELETE FROM refused_updates WHERE update_id=?", [(uid,) for uid in redelivered]
+        )
+        c.execute(
+            "DELETE FROM refused_updates WHERE refused_at<?", (time.time() - REFUSED_UPDATE_TTL,)
+        )
+
+@db_timed
 def get_user_subscriptions(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
+    subs = user_cache.get(user_id, "subs")
+    if subs is not _MISSING:
+        return subs
+    generation = user_cache.generation()
+    rows = get_db().execute(
         "SELECT channel_type, expires_at FROM subscriptions WHERE user_id=? AND expires_at>datetime('now') ORDER BY expires_at DESC",
         (user_id,),
-    )
+    ).fetchall()
     subs = []
-    for row in c.fetchall():
+    ttl = None
+    for row in rows:
         ch_type = row[0]
-        ex = row[1]
-        if isinstance(ex, str):
-            ex = datetime.strptime(ex, "%Y-%m-%d %H:%M:%S")
+        ex = _parse_db_datetime(row[1])
         formatted = ex.strftime("%d.%m.%Y")
         name = CHANNELS.get(ch_type, {}).get("name", f"Канал({ch_type})")
         subs.append((name, formatted))
-    conn.close()
+        # Список не должен пережить самую раннюю из подписок
+        left = (ex - datetime.now()).total_seconds()
+        ttl = left if ttl is None else min(ttl, left)
+    user_cache.set(user_id, "subs", subs, generation, ttl)
     return subs
 
+# -------------------- Pending invoices --------------------
+def _pending_row_to_info(row):
+    return {
+        "user_id": row[0],
+        "chat_id": row[1],
+        "duration_days": row[2],
+        "created_at": row[3],
+    }
+
+@db_timed
+def add_pending_invoice(inv_id, user_id, chat_id, duration_days, price_usd=None, source_key=None, pay_url=None):
+    """False — счёт с таким source_key уже записан (параллельный повтор апдейта)"""
+    with db_transaction() as c:
+        c.execute(
+            "INSERT OR IGNORE INTO pending_invoices (invoice_id, user_id, chat_id, duration_days, status, created_at, price_usd, source_key, pay_url) VALUES (?,?,?,?,'pending',?,?,?,?)",
+            (inv_id, user_id, chat_id, duration_days, time.time(), price_usd, source_key, pay_url),
+        )
+        if c.rowcount != 1:
+            return False
+        _bump_stat(c, "invoice:crypto", price_usd or 0)
+    return True
+
+@db_timed
+def find_invoice_by_source(source_key):
+    """Ссылка на оплату счёта, уже выставленного по этому апдейту"""
+    row = get_db().execute(
+        "SELECT pay_url FROM pending_invoices WHERE source_key=?", (source_key,)
+    ).fetchone()
+    return row[0] if row else None
+
+@db_timed
+def count_pending_invoices():
+    return get_db().execute(
+        "SELECT COUNT(*) FROM pending_invoices WHERE status='pending'"
+    ).fetchone()[0]
+
+@db_timed
+def load_pending_invoices():
+    """Перечитывает ожидающие инвойсы из БД (их могли создать другие воркеры)"""
+    rows = get_db().execute(
+        "SELECT invoice_id, user_id, chat_id, duration_days, created_at FROM pending_invoices WHERE status='pending'"
+    ).fetchall()
+    pending = {row[0]: _pending_row_to_info(row[1:]) for row in rows}
+    active_crypto_invoices.clear()
+    active_crypto_invoices.update(pending)
+    return pending
+
+@db_timed
+def set_pending_invoice_status(inv_id, status):
+    """Переводит инвойс из pending. True — только у того, кто перевёл первым."""
+    with db_transaction() as c:
+        c.execute(
+            "UPDATE pending_invoices SET status=? WHERE invoice_id=? AND status='pending'",
+            (status, inv_id),
+        )
+        changed = c.rowcount == 1
+    active_crypto_invoices.pop(inv_id, None)
+    return changed
+
+@db_timed
+def expire_pending_invoices(older_than):
+    with db_transaction() as c:
+        c.execute(
+            "SELECT invoice_id FROM pending_invoices WHERE status='pending' AND created_at<?",
+            (older_than,),
+        )
+        expired = [row[0] for row in c.fetchall()]
+        if expired:
+            c.execute(
+                "UPDATE pending_invoices SET status='expired' WHERE status='pending' AND created_at<?",
+                (older_than,),
+            )
+    for inv_id in expired:
+        active_crypto_invoices.pop(inv_id, None)
+    return expired
+
+print(f"📥 {count_pending_invoices()} pending crypto invoices")
+
+# -------------------- Leases --------------------
+@db_timed
+def acquire_lease(name, ttl, owner=INSTANCE_ID):
+    """Берёт или продлевает аренду. True — аренда у owner до now + ttl."""
+    now = time.time()
+    with db_transaction() as c:
+        c.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at WHERE leases.owner=excluded.owner OR leases.expires_at<?",
+            (name, owner, now + ttl, now),
+        )
+        return c.rowcount == 1
+
+@db_timed
+def release_lease(name, owner=INSTANCE_ID):
+    with db_transaction() as c:
+        c.execute("DELETE FROM leases WHERE name=? AND owner=?", (name, owner))
+
+class Lease:
+    """Аренда, которую фоновый поток продлевает каждые ttl/3 секунд.
+    Локально считаем её своей на 2/3 срока, чтобы не пересечься со следующим владельцем."""
+
+    def __init__(self, name, ttl=LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self._held_until = 0.0
+
+    def held(self):
+        return time.time() < self._held_until
+
+    def renew(self):
+        was_held = self.held()
+        try:
+            ok = acquire_lease(self.name, self.ttl)
+        except sqlite3.Error as e:
+            print(f"Lease {self.name} renew error:", e)
+            ok = False
+        self._held_until = time.time() + self.ttl * 2 / 3 if ok else 0.0
+        if ok != was_held:
+            print(f"👑 {INSTANCE_ID} {'acquired' if ok else 'lost'} lease {self.name}")
+        return ok
+
+    def loop(self):
+        while True:
+            self.renew()
+            time.sleep(self.ttl / 3)
+
+    def wait(self):
+        while not self.held():
+            time.sleep(self.ttl / 3)
+
+# Кто держит эту аренду, тот опрашивает CryptoBot, обновляет курсы,
+# обрабатывает окончание подписок, рассылки и long polling
+jobs_lease = Lease("background-jobs")
+# Аренда на имя процесса: пока она жива, его записи в журнале апдейтов не трогают
+instance_lease = Lease(f"instance:{INSTANCE_ID}")
+
 # -------------------- Invite link --------------------
+def _invite_link_payload(name, expires_at):
+    return {
+        "chat_id": int(PRIVATE_CHANNEL_ID),
+        "name": name,
+        "expire_date": int(expires_at.timestamp()),
+        "member_limit": 1,
+        "creates_join_request": False,
+    }
+
+def _invite_link_result(res):
+    if res and res.get("ok"):
+        return res["result"]["invite_link"]
+    print("createChatInviteLink error:", res)
+    return None
+
 def generate_invite_link(user_id, duration_days=30):
+    """Ссылка из пула, если есть. None — пул пуст: пользователь записан
+    в invite_deliveries, ссылку создаст и пришлёт invite_pool_loop."""
     try:
-        chat_id = int(PRIVATE_CHANNEL_ID)
-        expire_timestamp = int(time.time()) + duration_days * 24 * 3600
-        data = {
-            "chat_id": chat_id,
-            "name": f"Premium for user_{user_id}",
-            "expire_date": expire_timestamp,
-            "member_limit": 1,
-            "creates_join_request": False,
-        }
-        res = tg_post("createChatInviteLink", data)
-        if res and res.get("ok"):
-            invite = res["result"]["invite_link"]
-            save_invite_link(
-                user_id, invite, datetime.now() + timedelta(days=duration_days)
-            )
+        invite = take_pooled_invite_link(user_id)
+        if invite:
             return invite
-    except:
-        pass
+        # Обработчик не ждёт очередь отправки: createChatInviteLink идёт
+        # под общим лимитом и занял бы поток диспетчера на секунды
+        record_invite_delivery(user_id, duration_days)
+    except sqlite3.Error as e:
+        print("invite pool error:", e)
+        return create_invite_link(user_id, duration_days)
+    invite_pool_wakeup.set()
     return None
 
+def create_invite_link(user_id, duration_days):
+    # Через очередь отправки: 429 переждёт и повторит OutboundQueue
+    try:
+        expires_at = datetime.now() + timedelta(days=duration_days)
+        invite = _invite_link_result(wait_result(tg_send(
+            "createChatInviteLink",
+            _invite_link_payload(f"Premium for user_{user_id}", expires_at),
+            priority=PRIORITY_MESSAGE,
+        )))
+        if invite:
+            save_invite_link(user_id, invite, expires_at)
+        return invite
+    except Exception as e:
+        print(f"❌ Error creating invite link for {user_id}: {e}")
+    return None
+
+@db_timed
+def record_invite_delivery(user_id, duration_days):
+    with db_transaction() as c:
+        c.execute(
+            "INSERT OR REPLACE INTO invite_deliveries (user_id, duration_days, created_at) VALUES (?,?,?)",
+            (user_id, duration_days, time.time()),
+        )
+
+def deliver_pending_invites():
+    """Досылает ссылки тем, кому их не удалось выдать при оплате"""
+    rows = get_db().execute(
+        "SELECT user_id, duration_days FROM invite_deliveries ORDER BY user_id LIMIT ?",
+        (EXPIRY_BATCH_SIZE,),
+    ).fetchall()
+    delivered = 0
+    for user_id, duration_days in rows:
+        invite = take_pooled_invite_link(user_id) or create_invite_link(user_id, duration_days)
+        if not invite:
+            # Telegram всё ещё не отвечает — попробуем на следующем проходе
+            break
+        # В личном чате chat_id совпадает с user_id
+        send_message(
+            user_id,
+            f"🔗 Ваша ссылка на канал: {invite}\n⚠️ Ссылка действительна только для одного использования!",
+        )
+        with db_transaction() as c:
+            c.execute("DELETE FROM invite_deliveries WHERE user_id=?", (user_id,))
+        delivered += 1
+    return delivered
+
+invite_pool_wakeup = threading.Event()
+
+@db_timed
+def take_pooled_invite_link(user_id):
+    """Атомарно закрепляет за пользователем одну свободную ссылку пула."""
+    fresh_until = datetime.now() + timedelta(days=INVITE_ROTATE_DAYS)
+    with db_transaction() as c:
+        row = c.execute(
+            "SELECT id, invite_link FROM invite_links INDEXED BY idx_invite_links_pool WHERE user_id IS NULL AND revoked_at IS NULL AND expires_at>? ORDER BY expires_at LIMIT 1",
+            (fresh_until,),
+        ).fetchone()
+        if not row:
+            invite = None
+        else:
+            c.execute(
+                "UPDATE invite_links SET user_id=?, assigned_at=CURRENT_TIMESTAMP WHERE id=?",
+                (user_id, row[0]),
+            )
+            invite = row[1]
+    invite_pool_wakeup.set()
+    return invite
+
+@db_timed
+def count_pooled_invite_links():
+    return get_db().execute(
+        "SELECT COUNT(*) FROM invite_links INDEXED BY idx_invite_links_pool WHERE user_id IS NULL AND revoked_at IS NULL AND expires_at>?",
+        (datetime.now() + timedelta(days=INVITE_ROTATE_DAYS),),
+    ).fetchone()[0]
+
+def rotate_invite_pool():
+    """Отзывает свободные ссылки, которые скоро истекут."""
+    rows = get_db().execute(
+        "SELECT id, invite_link FROM invite_links INDEXED BY idx_invite_links_pool WHERE user_id IS NULL AND revoked_at IS NULL AND expires_at<=?",
+        (datetime.now() + timedelta(days=INVITE_ROTATE_DAYS),),
+    ).fetchall()
+    if not rows:
+        return 0
+    channel_id = int(PRIVATE_CHANNEL_ID)
+    futures = [
+        tg_send(
+            "revokeChatInviteLink",
+            {"chat_id": channel_id, "invite_link": link},
+            priority=PRIORITY_BULK,
+        )
+        for _, link in rows
+    ]
+    for fut in futures:
+        wait_result(fut, timeout=None)
+    with db_transaction() as c:
+        c.executemany(
+            "UPDATE invite_links SET revoked_at=CURRENT_TIMESTAMP WHERE id=? AND user_id IS NULL",
+            [(row[0],) for row in rows],
+        )
+    return len(rows)
+
+def refill_invite_pool():
+    missing = INVITE_POOL_SIZE - count_pooled_invite_links()
+    if missing <= 0:
+        return 0
+    expires_at = datetime.now() + timedelta(days=INVITE_LINK_DAYS)
+    # Фоновая подготовка не должна отнимать лимит у ответов пользователям
+    futures = [
+        tg_send(
+            "createChatInviteLink",
+            _invite_link_payload("Premium", expires_at),
+            priority=PRIORITY_BULK,
+        )
+        for _ in range(missing)
+    ]
+    links = [_invite_link_result(wait_result(fut, timeout=None)) for fut in futures]
+    links = [link for link in links if link]
+    with db_transaction() as c:
+        c.executemany(
+            "INSERT INTO invite_links (user_id, invite_link, expires_at) VALUES (NULL,?,?)",
+            [(link, expires_at) for link in links],
+        )
+    return len(links)
+
+def invite_pool_loop():
+    while True:
+        jobs_lease.wait()
+        invite_pool_wakeup.clear()
+        try:
+            rotated = created = 0
+            if INVITE_POOL_SIZE > 0:
+                rotated = rotate_invite_pool()
+                created = refill_invite_pool()
+            delivered = deliver_pending_invites()
+            if rotated or created or delivered:
+                print(f"🔗 Invite pool: {created} created, {rotated} rotated, {delivered} delivered")
+        except Exception as e:
+            print("invite pool loop error", e)
+        invite_pool_wakeup.wait(INVITE_POOL_CHECK)
+
 # -------------------- Keyboards --------------------
 def create_main_keyboard():
     return {
@@ -219,8 +1573,9 @@ def create_main_keyboard():
         ]
     }
 
-def create_premium_keyboard(user_id):
-    bal = get_user_balance(user_id)
+def create_premium_keyboard(user_id, bal=None):
+    if bal is None:
+        bal = get_user_balance(user_id)
     ch = CHANNELS["premium"]
     kb = []
     if bal >= ch["price_stars"]:
@@ -262,45 +1617,133 @@ def create_crypto_keyboard():
         ]
     }
 
-# -------------------- CryptoBot --------------------
-def update_crypto_prices_loop():
-    global crypto_prices
-    while True:
-        try:
-            response = requests.get(
-                "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin,ethereum,toncoin,tether&vs_currencies=usd",
-                timeout=10,
-            )
-            if response.status_code == 200:
-                data = response.json()
-                crypto_prices["BTC"] = data["bitcoin"]["usd"]
-                crypto_prices["ETH"] = data["ethereum"]["usd"]
-                crypto_prices["TON"] = data["toncoin"]["usd"]
-                crypto_prices["USDT"] = 1.0
-                print(f"💰 Updated prices: BTC=${crypto_prices['BTC']}, ETH=${crypto_prices['ETH']}, TON=${crypto_prices['TON']}")
-        except Exception as e:
-            print("Error updating prices:", e)
-            # Fallback цены (реальные на ноябрь 2024)
-            crypto_prices.update({
-                "BTC": 90000,    # $90,000 за BTC
-                "ETH": 3500,     # $3,500 за ETH
-                "TON": 2.0,      # $2.0 за TON
-                "USDT": 1.0
-            })
-        time.sleep(300)  # Обновляем каждые 5 минут
-
-def get_crypto_amounts(price_usd):
-    """Возвращает правильные суммы для всех криптовалют"""
-    global crypto_prices
+# -------------------- Prices --------------------
+# Цены на ноябрь 2024: до первого успешного обновления считаются устаревшими
+FALLBACK_PRICES = {
+    "BTC": 90000,    # $90,000 за BTC
+    "ETH": 3500,     # $3,500 за ETH
+    "TON": 2.0,      # $2.0 за TON
+    "USDT": 1.0
+}
+# Знаков после запятой в сумме инвойса
+PRICE_DECIMALS = {"BTC": 6, "ETH": 4, "TON": 2, "USDT": 2}
+
+def fetch_coingecko_prices():
+    response = http_get(
+        "coingecko",
+        "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin,ethereum,toncoin,tether&vs_currencies=usd",
+    )
+    response.raise_for_status()
+    data = response.json()
     return {
-        "BTC": round(price_usd / crypto_prices["BTC"], 6),
-        "ETH": round(price_usd / crypto_prices["ETH"], 4),
-        "TON": round(price_usd / crypto_prices["TON"], 2),
-        "USDT": round(price_usd, 2)
+        "BTC": data["bitcoin"]["usd"],
+        "ETH": data["ethereum"]["usd"],
+        "TON": data["toncoin"]["usd"],
+        "USDT": 1.0,
     }
 
-def create_crypto_invoice(price_usd, currency="USDT", description="Подписка"):
-    amounts = get_crypto_amounts(price_usd)
+def fetch_static_prices():
+    return dict(FALLBACK_PRICES)
+
+PRICE_SOURCES = {
+    "coingecko": fetch_coingecko_prices,
+    "static": fetch_static_prices,
+}
+
+def compute_crypto_amounts(price_usd, prices):
+    return {
+        asset: round(price_usd / prices[asset], decimals)
+        for asset, decimals in PRICE_DECIMALS.items()
+    }
+
+class PriceSnapshot:
+    """Неизменяемый снимок курсов и готовой таблицы сумм по продуктам.
+    Обновление — замена ссылки целиком, поэтому читать можно без блокировок."""
+
+    def __init__(self, prices, updated_at):
+        self.prices = prices
+        self.updated_at = updated_at
+        self.quotes = {
+            key: compute_crypto_amounts(ch["price_usd"], prices)
+            for key, ch in CHANNELS.items()
+            if "price_usd" in ch
+        }
+
+    def age(self):
+        return time.time() - self.updated_at
+
+    def is_stale(self):
+        return self.age() > PRICE_MAX_AGE
+
+class PriceFeed:
+    def __init__(self, source):
+        self.source = source
+        self.snapshot = PriceSnapshot(FALLBACK_PRICES, 0)
+
+    def refresh(self):
+        prices = self.source()
+        self.snapshot = PriceSnapshot(prices, time.time())
+        set_state(
+            "crypto_prices",
+            json.dumps({"prices": prices, "updated_at": self.snapshot.updated_at}),
+        )
+        return prices
+
+    def load_shared(self):
+        """Курсы, опубликованные лидером в bot_state"""
+        raw = get_state("crypto_prices")
+        if not raw:
+            return
+        shared = json.loads(raw)
+        if shared["updated_at"] > self.snapshot.updated_at:
+            self.snapshot = PriceSnapshot(shared["prices"], shared["updated_at"])
+
+    def loop(self):
+        failures = 0
+        while True:
+            if not jobs_lease.held():
+                try:
+                    self.load_shared()
+                except Exception as e:
+                    print("Error loading shared prices:", e)
+                time.sleep(PRICE_SYNC_INTERVAL)
+                continue
+            try:
+                # Новый лидер продолжает с последних опубликованных цен
+                self.load_shared()
+                if self.snapshot.age() < PRICE_REFRESH_INTERVAL and not failures:
+                    time.sleep(PRICE_REFRESH_INTERVAL - self.snapshot.age())
+                    continue
+                prices = self.refresh()
+                failures = 0
+                delay = PRICE_REFRESH_INTERVAL
+                print(f"💰 Updated prices: BTC=${prices['BTC']}, ETH=${prices['ETH']}, TON=${prices['TON']}")
+            except Exception as e:
+                # Последние удачные цены остаются в силе, повторяем с нарастающей паузой
+                failures += 1
+                delay = min(PRICE_REFRESH_INTERVAL, PRICE_RETRY_MIN * 2 ** (failures - 1))
+                print(f"Error updating prices (age {int(self.snapshot.age())}s):", e)
+            time.sleep(delay)
+
+price_feed = PriceFeed(PRICE_SOURCES[PRICE_SOURCE])
+
+def update_crypto_prices_loop():
+    price_feed.loop()
+
+def get_crypto_amounts(price_usd, product=None):
+    """Возвращает правильные суммы для всех криптовалют"""
+    snapshot = price_feed.snapshot
+    if product in snapshot.quotes:
+        return snapshot.quotes[product]
+    return compute_crypto_amounts(price_usd, snapshot.prices)
+
+# -------------------- CryptoBot --------------------
+def create_crypto_invoice(price_usd, currency="USDT", description="Подписка", product=None):
+    snapshot = price_feed.snapshot
+    if snapshot.is_stale():
+        print(f"❌ Prices are {int(snapshot.age())}s old, refusing {currency} invoice")
+        return None
+    amounts = get_crypto_amounts(price_usd, product)
     amount = amounts.get(currency)
     
     if amount is None:
@@ -326,7 +1769,7 @@ def create_crypto_invoice(price_usd, currency="USDT", description="Подпис
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        response = http_post("cryptobot", url, headers=headers, json=payload)
         result = response.json()
         print(f"📄 CryptoBot {currency} response: {result}")
         
@@ -340,69 +1783,536 @@ def create_crypto_invoice(price_usd, currency="USDT", description="Подпис
         print(f"❌ CryptoBot API error for {currency}: {e}")
         return None
 
-def check_crypto_invoice(invoice_id):
+def check_crypto_invoices(invoice_ids):
+    """Статусы инвойсов пачками по CRYPTO_BATCH_SIZE: {invoice_id: invoice}"""
     url = f"{CRYPTOBOT_API}/getInvoices"
     headers = {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
-    try:
-        r = requests.get(
-            url, headers=headers, params={"invoice_ids": invoice_id}, timeout=10
+    found = {}
+    ids = list(invoice_ids)
+    for i in range(0, len(ids), CRYPTO_BATCH_SIZE):
+        chunk = ids[i:i + CRYPTO_BATCH_SIZE]
+        try:
+            r = http_get(
+                "cryptobot",
+                url,
+                headers=headers,
+                params={
+                    "invoice_ids": ",".join(str(x) for x in chunk),
+                    "count": len(chunk),
+                },
+            )
+            res = r.json()
+            if res.get("ok"):
+                for item in res["result"]["items"]:
+                    found[item.get("invoice_id")] = item
+        except Exception as e:
+            print(f"Error checking invoices: {e}")
+    return found
+
+@db_timed
+def claim_crypto_invoice(inv_id):
+    """Переводит инвойс в paid и создаёт подписку одной транзакцией.
+    Вернёт (info, expires_at) только одному вызывающему, поэтому вебхук
+    и опрос не подтвердят оплату дважды. Если транзакция не прошла,
+    инвойс остаётся pending и будет подобран при следующей сверке."""
+    with db_transaction() as c:
+        row = c.execute(
+            "SELECT user_id, chat_id, duration_days, created_at, price_usd FROM pending_invoices WHERE invoice_id=? AND status='pending'",
+            (inv_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        info = _pending_row_to_info(row[:4])
+        c.execute(
+            "UPDATE pending_invoices SET status='paid' WHERE invoice_id=? AND status='pending'",
+            (inv_id,),
         )
-        res = r.json()
-        if res.get("ok") and res["result"]["items"]:
-            return res["result"]["items"][0]
+        _bump_stat(c, "paid:crypto", row[4] or 0)
+        expires_at = _insert_subscription(
+            c, info["user_id"], "premium", info["duration_days"] or 30, "crypto"
+        )
+        _note_user_change(c, info["user_id"])
+    active_crypto_invoices.pop(inv_id, None)
+    user_cache.invalidate(info["user_id"], "subs")
+    expiry_wakeup.set()
+    return info, expires_at
+
+def confirm_crypto_payment(inv_id, info, expires_at):
+    """Ссылка и уведомление после того, как подписка уже записана"""
+    try:
+        user_id = info["user_id"]
+        chat_id = info["chat_id"]
+        dur = info.get("duration_days") or 30
+        invite = generate_invite_link(user_id, dur)
+        msg = f"🎉 <b>Оплата подтверждена!</b>\n💎 Подписка {dur} дней\n📅 До {expires_at.strftime('%d.%m.%Y')}"
+        if invite:
+            msg += f"\n🔗 Ваша ссылка: {invite}\n⚠️ Ссылка действительна только для одного использования!"
+        else:
+            msg += "\n🔗 Ссылку на канал пришлём отдельным сообщением."
+        send_message(chat_id, msg)
     except Exception as e:
-        print(f"Error checking invoice: {e}")
-    return None
+        print(f"❌ Error confirming invoice {inv_id}: {e}")
+
+crypto_confirm_pool = ThreadPoolExecutor(
+    max_workers=CRYPTO_CONFIRM_WORKERS, thread_name_prefix="crypto-confirm"
+)
 
 def crypto_checker_loop():
     while True:
+        jobs_lease.wait()
         now = time.time()
-        to_remove = []
-        for inv_id, info in list(active_crypto_invoices.items()):
-            if now - info["created_at"] > 2 * 3600:
-                to_remove.append(inv_id)
+        try:
+            expire_pending_invoices(now - CRYPTO_INVOICE_TTL)
+            pending = load_pending_invoices()
+        except sqlite3.Error as e:
+            print("Error loading invoices:", e)
+            pending = dict(active_crypto_invoices)
+        if pending:
+            for inv_id, inv_info in check_crypto_invoices(pending).items():
+                status = inv_info.get("status")
+                if status == "expired":
+                    try:
+                        set_pending_invoice_status(inv_id, "expired")
+                    except sqlite3.Error as e:
+                        print(f"Error expiring invoice {inv_id}:", e)
+                elif status == "paid":
+                    try:
+                        claimed = claim_crypto_invoice(inv_id)
+                    except sqlite3.Error as e:
+                        print(f"Error activating invoice {inv_id}:", e)
+                        continue
+                    if claimed:
+                        crypto_confirm_pool.submit(confirm_crypto_payment, inv_id, *claimed)
+        if CRYPTOBOT_WEBHOOK:
+            time.sleep(CRYPTO_RECONCILE_INTERVAL)
+            continue
+        # Свежие инвойсы чаще всего оплачивают в первые минуты
+        fresh = any(now - i["created_at"] < CRYPTO_FRESH_WINDOW for i in pending.values())
+        time.sleep(CRYPTO_POLL_FAST if fresh else CRYPTO_POLL_SLOW)
+
+def verify_cryptobot_signature(body, signature):
+    """Подпись CryptoBot: HMAC-SHA256 тела запроса с ключом SHA256(токена)"""
+    if not CRYPTOBOT_TOKEN or not signature:
+        return False
+    secret = hashlib.sha256(CRYPTOBOT_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+# -------------------- Broadcast --------------------
+# Рассылки, которые ведёт этот процесс: аренда у них наша, поэтому
+# acquire_lease сам по себе не отличит их от брошенных
+_running_broadcasts = set()
+_running_broadcasts_lock = threading.Lock()
+
+def _launch_broadcast(broadcast_id):
+    """Запускает поток рассылки, если в этом процессе он ещё не идёт"""
+    with _running_broadcasts_lock:
+        if broadcast_id in _running_broadcasts:
+            return False
+        _running_broadcasts.add(broadcast_id)
+    threading.Thread(
+        target=run_broadcast, args=(broadcast_id,), name=f"broadcast-{broadcast_id}", daemon=True
+    ).start()
+    return True
+
+def start_broadcast(text, source_key=None):
+    """Создаёт и запускает рассылку. Повтор с тем же source_key вернёт id
+    уже созданной рассылки, не запуская её ещё раз (её подхватит watchdog)."""
+    with db_transaction() as c:
+        c.execute(
+            "INSERT OR IGNORE INTO broadcasts (text, source_key) VALUES (?, ?)", (text, source_key)
+        )
+        if c.rowcount != 1:
+            return c.execute(
+                "SELECT id FROM broadcasts WHERE source_key=?", (source_key,)
+            ).fetchone()[0]
+        broadcast_id = c.lastrowid
+    _launch_broadcast(broadcast_id)
+    return broadcast_id
+
+def resume_broadcasts():
+    """Подхватывает незавершённые рассылки, у которых никто не продлевает аренду"""
+    rows = get_db().execute("SELECT id FROM broadcasts WHERE status='running'").fetchall()
+    for (broadcast_id,) in rows:
+        with _running_broadcasts_lock:
+            if broadcast_id in _running_broadcasts:
                 continue
-            inv_info = check_crypto_invoice(inv_id)
-            if inv_info and inv_info.get("status") == "paid":
-                user_id = info["user_id"]
-                chat_id = info["chat_id"]
-                dur = info.get("duration_days", 30)
-                create_user_subscription(user_id, "premium", dur)
-                invite = generate_invite_link(user_id, dur)
-                msg = f"🎉 <b>Оплата подтверждена!</b>\n💎 Подписка {dur} дней\n📅 До {(datetime.now()+timedelta(days=dur)).strftime('%d.%m.%Y')}"
-                if invite:
-                    msg += f"\n🔗 Ваша ссылка: {invite}\n⚠️ Ссылка действительна только для одного использования!"
-                send_message(chat_id, msg)
-                to_remove.append(inv_id)
-        for rid in to_remove:
-            active_crypto_invoices.pop(rid, None)
-        time.sleep(30)
+        if not acquire_lease(f"broadcast-{broadcast_id}", BROADCAST_LEASE_TTL):
+            continue
+        if _launch_broadcast(broadcast_id):
+            print(f"📣 Resuming broadcast #{broadcast_id}")
+
+def broadcast_watchdog_loop():
+    while True:
+        jobs_lease.wait()
+        try:
+            resume_broadcasts()
+        except Exception as e:
+            print("Error resuming broadcasts:", e)
+        time.sleep(60)
+
+def run_broadcast(broadcast_id):
+    try:
+        _run_broadcast(broadcast_id)
+    finally:
+        with _running_broadcasts_lock:
+            _running_broadcasts.discard(broadcast_id)
+
+def _run_broadcast(broadcast_id):
+    """Рассылка по users пачками с курсором по user_id. Прогресс сохраняется
+    после каждой пачки, поэтому после рестарта рассылка продолжается с места остановки."""
+    lease_name = f"broadcast-{broadcast_id}"
+    db = get_db()
+    row = db.execute(
+        "SELECT text, last_user_id FROM broadcasts WHERE id=?", (broadcast_id,)
+    ).fetchone()
+    if not row:
+        return
+    text, cursor = row
+    # Текст админа уходит как есть: разметка HTML в нём не интерпретируется
+    text = html.escape(text, quote=False)
+    while True:
+        # Аренда не даёт двум воркерам вести одну и ту же рассылку
+        if not acquire_lease(lease_name, BROADCAST_LEASE_TTL):
+            print(f"📣 Broadcast #{broadcast_id} is owned by another worker")
+            return
+        batch = db.execute(
+            "SELECT user_id FROM users WHERE user_id>? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+            (cursor, BROADCAST_BATCH_SIZE),
+        ).fetchall()
+        if not batch:
+            break
+        # Низкий приоритет: ответы пользователям обгоняют рассылку в очереди отправки
+        futures = [
+            (uid, send_message(uid, text, priority=PRIORITY_BULK)) for (uid,) in batch
+        ]
+        sent = failed = 0
+        blocked = []
+        for uid, fut in futures:
+            res = wait_result(fut, timeout=None)
+            if res and res.get("ok"):
+                sent += 1
+            elif res and res.get("error_code") == 403:
+                blocked.append((uid,))
+            else:
+                failed += 1
+        cursor = batch[-1][0]
+        with db_transaction() as c:
+            if blocked:
+                c.executemany(
+                    "UPDATE users SET blocked_at=CURRENT_TIMESTAMP WHERE user_id=?", blocked
+                )
+            c.execute(
+                "UPDATE broadcasts SET last_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+? WHERE id=?",
+                (cursor, sent, failed, len(blocked), broadcast_id),
+            )
+        # Отметку о блокировке снимет следующее сообщение пользователя (ProfileSync.flush)
+    with db_transaction() as c:
+        c.execute(
+            "UPDATE broadcasts SET status='done', finished_at=CURRENT_TIMESTAMP WHERE id=?",
+            (broadcast_id,),
+        )
+    release_lease(lease_name)
+    sent, failed, blocked = db.execute(
+        "SELECT sent, failed, blocked FROM broadcasts WHERE id=?", (broadcast_id,)
+    ).fetchone()
+    print(f"📣 Broadcast #{broadcast_id} done: sent={sent} failed={failed} blocked={blocked}")
+    if ADMIN_ID:
+        send_message(
+            ADMIN_ID,
+            f"📣 Рассылка #{broadcast_id} завершена\n✅ Доставлено: {sent}\n🚫 Заблокировали бота: {blocked}\n❌ Ошибки: {failed}",
+        )
+
+# -------------------- Subscription expiry --------------------
+# Будит планировщик, когда появляется подписка с более ранним сроком
+expiry_wakeup = threading.Event()
+
+def next_expiry_time():
+    """Ближайший момент, когда планировщику есть что делать (по индексу expires_at)"""
+    db = get_db()
+    candidates = []
+    row = db.execute(
+        "SELECT MIN(expires_at) FROM subscriptions WHERE ended_at IS NULL"
+    ).fetchone()
+    if row[0]:
+        candidates.append(_parse_db_datetime(row[0]))
+    if SUB_REMINDER_DAYS:
+        row = db.execute(
+            "SELECT MIN(expires_at) FROM subscriptions WHERE ended_at IS NULL AND reminded_at IS NULL"
+        ).fetchone()
+        if row[0]:
+            candidates.append(_parse_db_datetime(row[0]) - timedelta(days=SUB_REMINDER_DAYS))
+    return min(candidates) if candidates else None
+
+def _placeholders(items):
+    return ",".join("?" * len(items))
+
+def send_expiry_reminders(now):
+    rows = get_db().execute(
+        "SELECT id, user_id, expires_at FROM subscriptions WHERE ended_at IS NULL AND reminded_at IS NULL AND expires_at<=? ORDER BY expires_at LIMIT ?",
+        (now + timedelta(days=SUB_REMINDER_DAYS), EXPIRY_BATCH_SIZE),
+    ).fetchall()
+    if not rows:
+        return 0
+    user_ids = list({row[1] for row in rows})
+    # Тем, кто уже продлил подписку, напоминать не нужно
+    renewed = {
+        uid
+        for (uid,) in get_db().execute(
+            f"SELECT DISTINCT user_id FROM subscriptions WHERE user_id IN ({_placeholders(user_ids)}) AND ended_at IS NULL AND expires_at>?",
+            (*user_ids, now + timedelta(days=SUB_REMINDER_DAYS)),
+        ).fetchall()
+    }
+    for sub_id, user_id, expires_at in rows:
+        if user_id in renewed or _parse_db_datetime(expires_at) <= now:
+            continue
+        send_message(
+            user_id,
+            f"⏳ Ваша подписка заканчивается {_parse_db_datetime(expires_at).strftime('%d.%m.%Y')}.\nПродлить её можно в главном меню: /start",
+            priority=PRIORITY_BULK,
+        )
+    with db_transaction() as c:
+        c.executemany(
+            "UPDATE subscriptions SET reminded_at=? WHERE id=?",
+            [(now, row[0]) for row in rows],
+        )
+    return len(rows)
+
+def end_expired_subscriptions(now):
+    rows = get_db().execute(
+        "SELECT id, user_id FROM subscriptions WHERE ended_at IS NULL AND expires_at<=? ORDER BY expires_at LIMIT ?",
+        (now, EXPIRY_BATCH_SIZE),
+    ).fetchall()
+    if not rows:
+        return 0
+    user_ids = list({row[1] for row in rows})
+    still_active = {
+        uid
+        for (uid,) in get_db().execute(
+            f"SELECT DISTINCT user_id FROM subscriptions WHERE user_id IN ({_placeholders(user_ids)}) AND ended_at IS NULL AND expires_at>?",
+            (*user_ids, now),
+        ).fetchall()
+    }
+    lapsed = [uid for uid in user_ids if uid not in still_active]
+    if lapsed:
+        remove_channel_members(lapsed)
+        revoke_user_invite_links(lapsed)
+    with db_transaction() as c:
+        c.executemany(
+            "UPDATE subscriptions SET ended_at=? WHERE id=?",
+            [(now, row[0]) for row in rows],
+        )
+        gone = sum(
+            1
+            for uid in user_ids
+            if not c.execute(
+                "SELECT 1 FROM subscriptions WHERE user_id=? AND ended_at IS NULL LIMIT 1", (uid,)
+            ).fetchone()
+        )
+        if gone:
+            _bump_total(c, "active_subscribers", -gone)
+    print(f"⌛ Ended {len(rows)} subscriptions, removed {len(lapsed)} members")
+    return len(rows)
+
+def remove_channel_members(user_ids):
+    channel_id = int(PRIVATE_CHANNEL_ID)
+    # ban + unban исключает из канала, не оставляя пользователя в бан-листе
+    bans = [
+        tg_send(
+            "banChatMember",
+            {"chat_id": channel_id, "user_id": uid},
+            priority=PRIORITY_BULK,
+        )
+        for uid in user_ids
+    ]
+    for fut in bans:
+        wait_result(fut, timeout=None)
+    unbans = [
+        tg_send(
+            "unbanChatMember",
+            {"chat_id": channel_id, "user_id": uid, "only_if_banned": True},
+            priority=PRIORITY_BULK,
+        )
+        for uid in user_ids
+    ]
+    for fut in unbans:
+        wait_result(fut, timeout=None)
+
+def revoke_user_invite_links(user_ids):
+    rows = get_db().execute(
+        f"SELECT id, invite_link FROM invite_links WHERE user_id IN ({_placeholders(user_ids)}) AND revoked_at IS NULL",
+        user_ids,
+    ).fetchall()
+    if not rows:
+        return
+    channel_id = int(PRIVATE_CHANNEL_ID)
+    futures = [
+        tg_send(
+            "revokeChatInviteLink",
+            {"chat_id": channel_id, "invite_link": link},
+            priority=PRIORITY_BULK,
+        )
+        for _, link in rows
+    ]
+    for fut in futures:
+        wait_result(fut, timeout=None)
+    with db_transaction() as c:
+        c.executemany(
+            "UPDATE invite_links SET revoked_at=CURRENT_TIMESTAMP WHERE id=?",
+            [(row[0],) for row in rows],
+        )
+
+def subscription_expiry_loop():
+    while True:
+        jobs_lease.wait()
+        expiry_wakeup.clear()
+        wake_at = None
+        try:
+            now = datetime.now()
+            if SUB_REMINDER_DAYS:
+                while send_expiry_reminders(now) == EXPIRY_BATCH_SIZE:
+                    pass
+            while end_expired_subscriptions(now) == EXPIRY_BATCH_SIZE:
+                pass
+            wake_at = next_expiry_time()
+        except Exception as e:
+            print("Error in expiry scheduler:", e)
+        timeout = EXPIRY_MAX_SLEEP
+        if wake_at is not None:
+            timeout = min(max((wake_at - datetime.now()).total_seconds(), 1), EXPIRY_MAX_SLEEP)
+        expiry_wakeup.wait(timeout)
+
+# -------------------- Stats --------------------
+STATS_PERIODS = ((1, "Сегодня"), (7, "7 дней"), (30, "30 дней"))
+
+@db_timed
+def load_stats(days):
+    """Сумма дневных счётчиков за последние days дней (включая сегодня)"""
+    rows = get_db().execute(
+        "SELECT metric, SUM(count), SUM(amount) FROM stats_daily WHERE day>date('now', ?) GROUP BY metric",
+        (f"-{days} days",),
+    ).fetchall()
+    return {metric: (count, amount) for metric, count, amount in rows}
+
+@db_timed
+def load_stat_total(metric):
+    row = get_db().execute("SELECT value FROM stats_totals WHERE metric=?", (metric,)).fetchone()
+    return row[0] if row else 0
+
+def _conversion(stats, method):
+    invoices = stats.get(f"invoice:{method}", (0, 0))[0]
+    paid = stats.get(f"paid:{method}", (0, 0))[0]
+    rate = f"{paid * 100 / invoices:.0f}%" if invoices else "—"
+    return f"{paid}/{invoices} ({rate})"
+
+def stats_report():
+    lines = ["📊 <b>Статистика</b>"]
+    for days, title in STATS_PERIODS:
+        stats = load_stats(days)
+        zero = (0, 0)
+        lines += [
+            "",
+            f"<b>{title}</b>",
+            f"💰 Выручка: {stats.get('paid:stars', zero)[1]:.0f} ⭐ + ${stats.get('paid:crypto', zero)[1]:.2f}",
+            f"👤 Новые пользователи: {stats.get('user:new', zero)[0]}",
+            f"💎 Подписки: с баланса {stats.get('sub:balance', zero)[0]}, криптой {stats.get('sub:crypto', zero)[0]}",
+            f"🔄 Оплачено счетов: Stars {_conversion(stats, 'stars')}, крипта {_conversion(stats, 'crypto')}",
+        ]
+    lines += ["", f"👥 Активных подписчиков: {load_stat_total('active_subscribers')}"]
+    return "\n".join(lines)
+
+@db_timed
+def rebuild_stats():
+    """Пересчитывает stats_daily и stats_totals по исходным таблицам.
+    Читает таблицы целиком под блокировкой записи — запускать вне пиковых часов.
+    Выставленные Stars-счета нигде не хранятся, invoice:stars не восстанавливается."""
+    with db_transaction() as c:
+        c.execute("DELETE FROM stats_daily WHERE metric!='invoice:stars'")
+        c.execute("DELETE FROM stats_totals")
+        c.execute(
+            "INSERT INTO stats_daily (day, metric, count, amount) SELECT date(created_at), 'tx:' || type, COUNT(*), SUM(amount) FROM transactions GROUP BY 1, 2"
+        )
+        c.execute(
+            "INSERT INTO stats_daily (day, metric, count, amount) SELECT date(created_at), 'paid:stars', COUNT(*), SUM(amount) FROM transactions WHERE type='deposit' GROUP BY 1"
+        )
+        c.execute(
+            "INSERT INTO stats_daily (day, metric, count, amount) SELECT date(created_at), 'sub:' || COALESCE(method, 'other'), COUNT(*), 0 FROM subscriptions GROUP BY 1, 2"
+        )
+        c.execute(
+            "INSERT INTO stats_daily (day, metric, count, amount) SELECT date(created_at, 'unixepoch'), 'invoice:crypto', COUNT(*), SUM(COALESCE(price_usd, 0)) FROM pending_invoices GROUP BY 1"
+        )
+        c.execute(
+            "INSERT INTO stats_daily (day, metric, count, amount) SELECT date(created_at, 'unixepoch'), 'paid:crypto', COUNT(*), SUM(COALESCE(price_usd, 0)) FROM pending_invoices WHERE status='paid' GROUP BY 1"
+        )
+        c.execute(
+            "INSERT INTO stats_daily (day, metric, count, amount) SELECT date(created_at), 'user:new', COUNT(*), 0 FROM users GROUP BY 1"
+        )
+        c.execute(
+            "INSERT INTO stats_totals (metric, value) SELECT 'active_subscribers', COUNT(DISTINCT user_id) FROM subscriptions WHERE ended_at IS NULL"
+        )
 
 # -------------------- Handlers --------------------
+UPDATE_KINDS = ("message", "callback_query", "pre_checkout_query", "successful_payment")
+# Известные callback_data; остальное попадает в метрики как "other"
+CALLBACK_ACTIONS = {
+    "channel_free",
+    "channel_premium",
+    "pay_from_balance",
+    "buy_stars_for_sub",
+    "pay_crypto_premium",
+    "my_subs",
+    "back_main",
+} | {f"crypto_{asset}" for asset in PRICE_DECIMALS}
+
 def handle_update(update):
+    kind = next((k for k in UPDATE_KINDS if k in update), "other")
+    if kind == "message" and "successful_payment" in update["message"]:
+        kind = "successful_payment"
+    start = time.perf_counter()
+    try:
+        _route_update(update)
+    except Exception:
+        handler_errors.inc((kind,))
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        update_seconds.observe((kind,), elapsed)
+        if kind == "callback_query":
+            data = update["callback_query"].get("data")
+            callback_seconds.observe(
+                (data if data in CALLBACK_ACTIONS else "other",), elapsed
+            )
+
+def _route_update(update):
     if "message" in update:
-        handle_message(update["message"])
+        # successful_payment приходит как поле сервисного сообщения
+        if "successful_payment" in update["message"]:
+            handle_successful_payment(update["message"])
+        else:
+            handle_message(update["message"])
     elif "callback_query" in update:
         handle_callback(update["callback_query"])
     elif "pre_checkout_query" in update:
         answer_pre_checkout_query(update["pre_checkout_query"]["id"])
-    elif "successful_payment" in update:
-        handle_successful_payment(update)
 
-def handle_successful_payment(update):
-    msg = update.get("message", {})
+def handle_successful_payment(msg):
     user = msg.get("from", {})
     chat_id = msg.get("chat", {}).get("id")
     user_id = user.get("id")
-    payment_info = update.get("successful_payment", {})
+    payment_info = msg.get("successful_payment", {})
     if not payment_info:
         return
     total_amount = payment_info.get("total_amount", 0)
-    update_user_balance(user_id, total_amount)
-    add_transaction(user_id, "deposit", total_amount, "Пополнение через Telegram Stars")
+    charge_id = payment_info.get("telegram_payment_charge_id")
+    new_balance = credit_stars_payment(
+        user_id, total_amount, charge_id, "Пополнение через Telegram Stars"
+    )
+    if new_balance is None:
+        print(f"payment {charge_id} already credited, skipping")
+        return
     send_message(
         chat_id,
-        f"✅ Баланс пополнен на {total_amount} ⭐\n💰 На балансе: {get_user_balance(user_id)} ⭐",
+        f"✅ Баланс пополнен на {total_amount} ⭐\n💰 На балансе: {new_balance} ⭐",
         create_main_keyboard(),
     )
 
@@ -411,15 +2321,23 @@ def handle_message(message):
     user = message.get("from", {})
     user_id = user.get("id")
     text = message.get("text", "")
-    update_user_balance(
-        user_id, 0, user.get("username", ""), user.get("first_name", "")
-    )
+    profile_sync.touch(user_id, user.get("username", ""), user.get("first_name", ""))
     if text == "/start":
         send_message(
             chat_id,
             f"👋 Привет, {user.get('first_name','')}!\nВыберите действие:",
             create_main_keyboard(),
         )
+    elif (text == "/broadcast" or text.startswith("/broadcast ")) and ADMIN_ID and user_id == ADMIN_ID:
+        body = text[len("/broadcast"):].strip()
+        if not body:
+            send_message(chat_id, "Использование: /broadcast текст рассылки")
+        else:
+            # Ключ сообщения стабилен при повторе апдейта из журнала
+            broadcast_id = start_broadcast(body, f"message:{chat_id}:{message.get('message_id')}")
+            send_message(chat_id, f"📣 Рассылка #{broadcast_id} запущена")
+    elif text == "/stats" and ADMIN_ID and user_id == ADMIN_ID:
+        send_message(chat_id, stats_report())
     elif text == "/mysub":
         subs = get_user_subscriptions(user_id)
         if subs:
@@ -438,8 +2356,15 @@ def handle_callback(callback):
     data = callback.get("data")
     user_id = callback.get("from", {}).get("id")
     chat_id = callback.get("message", {}).get("chat", {}).get("id")
-    cb_id = callback.get("id")
+    message_id = callback.get("message", {}).get("message_id")
     ch = CHANNELS["premium"]
+    # Гасим «часики» на кнопке сразу, до запросов в БД и CryptoBot
+    answer_callback_query(callback.get("id"))
+
+    def show_menu(text, reply_markup=None):
+        if CALLBACK_MODE == "edit":
+            return edit_message(chat_id, message_id, text, reply_markup)
+        return send_message(chat_id, text, reply_markup)
 
     if data == "channel_free":
         chf = CHANNELS["free"]
@@ -448,7 +2373,7 @@ def handle_callback(callback):
         )
     elif data == "channel_premium":
         bal = get_user_balance(user_id)
-        amounts = get_crypto_amounts(ch["price_usd"])
+        amounts = get_crypto_amounts(ch["price_usd"], "premium")
         txt = (f"<b>{ch['name']}</b>\n\n{ch['description']}\n\n"
                f"💎 Стоимость: {ch['price_stars']} ⭐ (~{ch['price_rub']} ₽)\n"
                f"💰 На балансе: {bal} ⭐\n\n"
@@ -457,23 +2382,32 @@ def handle_callback(callback):
                f"• ETH: {amounts['ETH']}\n" 
                f"• TON: {amounts['TON']}\n"
                f"• USDT: {amounts['USDT']}")
-        send_message(chat_id, txt, create_premium_keyboard(user_id))
+        if price_feed.snapshot.is_stale():
+            txt += "\n\n⚠️ Курсы временно не обновляются, оплата криптой недоступна."
+        show_menu(txt, create_premium_keyboard(user_id, bal))
     elif data == "pay_from_balance":
-        bal = get_user_balance(user_id)
-        if bal >= ch["price_stars"]:
-            update_user_balance(user_id, -ch["price_stars"])
-            add_transaction(
-                user_id, "subscription", -ch["price_stars"], "Оплата подписки со счета"
-            )
-            expires_at = create_user_subscription(
-                user_id, "premium", ch["duration_days"]
-            )
+        purchase = purchase_subscription(
+            user_id,
+            "premium",
+            ch["price_stars"],
+            ch["duration_days"],
+            "Оплата подписки со счета",
+            # Ключ идемпотентности: переигранный из журнала callback не спишет звёзды второй раз
+            f"callback:{callback.get('id')}",
+        )
+        if purchase is ALREADY_APPLIED:
+            print(f"callback {callback.get('id')} purchase already applied, skipping")
+        elif purchase:
+            _, expires_at = purchase
             invite = generate_invite_link(user_id, ch["duration_days"])
             msg = f"✅ <b>Подписка активирована!</b>\n💎 Канал: {ch['name']}\n📅 Действует до: {expires_at.strftime('%d.%m.%Y')}"
             if invite:
                 msg += f"\n🔗 Ваша ссылка: {invite}\n⚠️ Ссылка действительна только для одного использования!"
+            else:
+                msg += "\n🔗 Ссылку на канал пришлём отдельным сообщением."
             send_message(chat_id, msg)
         else:
+            bal = get_user_balance(user_id)
             send_message(
                 chat_id,
                 f"❌ Недостаточно звёзд. Нужно {ch['price_stars']} ⭐, у вас {bal} ⭐",
@@ -482,6 +2416,7 @@ def handle_callback(callback):
         stars = ch["price_stars"]
         inv = send_stars_invoice(chat_id, stars, f"Покупка {stars} звёзд для подписки")
         if inv and inv.get("ok"):
+            bump_stat("invoice:stars", stars)
             send_message(
                 chat_id, "📋 Инвойс отправлен. Следуйте инструкциям Telegram оплаты."
             )
@@ -491,28 +2426,37 @@ def handle_callback(callback):
                 "❌ Не удалось создать инвойс (проверьте STARS_PROVIDER_TOKEN).",
             )
     elif data == "pay_crypto_premium":
-        send_message(chat_id, "Выберите валюту:", create_crypto_keyboard())
+        show_menu("Выберите валюту:", create_crypto_keyboard())
     elif data.startswith("crypto_"):
         cur = data.split("_")[1].upper()
-        amounts = get_crypto_amounts(ch["price_usd"])
+        amounts = get_crypto_amounts(ch["price_usd"], "premium")
         amount = amounts.get(cur)
         
         if amount is None:
             send_message(chat_id, f"❌ Не удалось рассчитать сумму для {cur}")
-            answer_callback_query(cb_id)
+            return
+        if price_feed.snapshot.is_stale():
+            send_message(chat_id, "❌ Курсы криптовалют временно недоступны. Попробуйте позже.")
+            return
+
+        # Повтор callback из журнала: второй счёт не выставляем, присылаем ссылку на первый
+        source_key = f"callback:{callback.get('id')}"
+        pay_url = find_invoice_by_source(source_key)
+        if pay_url:
+            send_message(chat_id, f"💎 Счёт уже выставлен\n🔗 Ссылка для оплаты: {pay_url}")
             return
 
         invoice = create_crypto_invoice(
-            ch["price_usd"], cur, f"Подписка {ch['name']} на {ch['duration_days']} дней"
+            ch["price_usd"], cur, f"Подписка {ch['name']} на {ch['duration_days']} дней", "premium"
         )
         if invoice:
             inv_id = invoice.get("invoice_id") or invoice.get("id")
-            active_crypto_invoices[inv_id] = {
-                "user_id": user_id,
-                "chat_id": chat_id,
-                "created_at": time.time(),
-                "duration_days": ch["duration_days"],
-            }
+            if not add_pending_invoice(
+                inv_id, user_id, chat_id, ch["duration_days"], ch["price_usd"],
+                source_key, invoice.get("pay_url"),
+            ):
+                print(f"callback {callback.get('id')} already has an invoice, {inv_id} left unused")
+                return
 
             send_message(
                 chat_id,
@@ -530,18 +2474,305 @@ def handle_callback(callback):
     elif data == "my_subs":
         subs = get_user_subscriptions(user_id)
         if not subs:
-            send_message(
-                chat_id, "❌ У вас нет активных подписок.", create_main_keyboard()
-            )
+            show_menu("❌ У вас нет активных подписок.", create_main_keyboard())
         else:
             txt = "📋 <b>Ваши активные подписки:</b>\n\n"
             for chn, ex in subs:
                 txt += f"• {chn}\n   └─ до <b>{ex}</b>\n"
             txt += "\nДля продления выберите канал в главном меню."
-            send_message(chat_id, txt, create_main_keyboard())
+            show_menu(txt, create_main_keyboard())
     elif data == "back_main":
-        send_message(chat_id, "Главное меню", create_main_keyboard())
-    answer_callback_query(cb_id)
+        show_menu("Главное меню", create_main_keyboard())
+
+# -------------------- Dispatcher --------------------
+def get_update_chat_id(update):
+    """Чат, к которому относится апдейт (для сохранения порядка)"""
+    if "message" in update:
+        return update["message"].get("chat", {}).get("id")
+    if "callback_query" in update:
+        cb = update["callback_query"]
+        return cb.get("message", {}).get("chat", {}).get("id") or cb.get("from", {}).get("id")
+    if "pre_checkout_query" in update:
+        return update["pre_checkout_query"].get("from", {}).get("id")
+    return None
+
+class UpdateDispatcher:
+    """Фиксированный пул воркеров. Апдейты одного чата всегда попадают
+    в одну и ту же очередь, поэтому обрабатываются строго по порядку."""
+
+    def __init__(self, workers, queue_size):
+        self.workers = max(1, workers)
+        per_worker = max(1, queue_size // self.workers)
+        self.queues = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for i, q in enumerate(self.queues):
+            threading.Thread(
+                target=self._worker, args=(q,), name=f"update-worker-{i}", daemon=True
+            ).start()
+
+    def _worker(self, q):
+        while True:
+            update = q.get()
+            with self._lock:
+                self.in_flight += 1
+            try:
+                handle_update(update)
+            except Exception as e:
+                print("handle_update error", e)
+            finally:
+                # И упавший апдейт считаем выполненным, иначе он будет переигрываться вечно
+                update_journal.done(update.get("update_id"))
+                with self._lock:
+                    self.in_flight -= 1
+                q.task_done()
+
+    def submit(self, update, block=False):
+        """Ставит апдейт в очередь. False — очередь переполнена."""
+        if not self._started:
+            self.start()
+        chat_id = get_update_chat_id(update)
+        idx = hash(chat_id) % self.workers if chat_id is not None else 0
+        try:
+            self.queues[idx].put(update, block=block)
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+class UpdateDeduplicator:
+    """Отсекает повторные доставки до постановки в очередь.
+
+    Последние update_id лежат в кольцевом буфере и множестве — проверка O(1).
+    Верхняя отметка периодически сохраняется в bot_state (только вперёд: её
+    пишут все воркеры) и после рестарта отсекает всё, что не выше неё, кроме
+    апдейтов из refused_updates — им вебхук ответил 429 и Telegram их повторит.
+    Сохраняется отметка предыдущего тика, чтобы апдейты, пришедшие не по порядку,
+    не попали под неё раньше времени."""
+
+    def __init__(self, window):
+        self.window = max(1, window)
+        self._ring = deque()
+        self._seen = set()
+        self._lock = threading.Lock()
+        self.restored_mark = int(get_state("update_high_water", "0"))
+        self._refused = load_refused_updates()
+        # Отклонённые раньше апдейты, которые дошли повторно: их строки удалит persist
+        self._redelivered = []
+        self._max_seen = self.restored_mark
+        self._pending_mark = self.restored_mark
+        self.duplicates = 0
+
+    def accept(self, update_id):
+        """True — апдейт новый и его нужно обработать."""
+        if update_id is None:
+            return True
+        with self._lock:
+            refused = update_id in self._refused
+            if update_id in self._seen or (update_id <= self.restored_mark and not refused):
+                self.duplicates += 1
+                return False
+            if refused:
+                self._refused.discard(update_id)
+                self._redelivered.append(update_id)
+            self._seen.add(update_id)
+            self._ring.append(update_id)
+            if len(self._ring) > self.window:
+                self._seen.discard(self._ring.popleft())
+            if update_id > self._max_seen:
+                self._max_seen = update_id
+            return True
+
+    def count_duplicate(self):
+        with self._lock:
+            self.duplicates += 1
+
+    def forget(self, update_id):
+        """Апдейт не принят в очередь — повторная доставка не должна считаться дублем,
+        в том числе в другом воркере и после рестарта."""
+        if update_id is None:
+            return
+        with self._lock:
+            self._seen.discard(update_id)
+            self._refused.add(update_id)
+            # Из кольца не удаляем: лишний id в нём безвреден и уйдёт сам
+        try:
+            record_refused_update(update_id)
+        except sqlite3.Error as e:
+            print(f"update {update_id} refusal not recorded:", e)
+
+    def persist(self):
+        with self._lock:
+            mark = self._pending_mark
+            self._pending_mark = self._max_seen
+            redelivered, self._redelivered = self._redelivered, []
+        save_update_dedup_state(mark, redelivered)
+
+    def loop(self):
+        while True:
+            time.sleep(UPDATE_DEDUP_PERSIST)
+            try:
+                self.persist()
+            except Exception as e:
+                print("update dedup persist error", e)
+
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_WINDOW)
+
+# -------------------- Update journal --------------------
+class UpdateJournal:
+    """Журнал принятых апдейтов в SQLite. Один поток-писатель собирает всё,
+    что накопилось, и фиксирует одной транзакцией (group commit): вставки
+    новых апдейтов и удаление выполненных. Записи, оставшиеся от упавшего
+    процесса, подбирает recover."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._done = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._pruned_at = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._writer, name="update-journal", daemon=True).start()
+
+    def append(self, update):
+        """Future, который завершается после коммита записи: True — апдейт записан,
+        False — он уже есть в журнале (повторная доставка, возможно в другой воркер)"""
+        future = Future()
+        update_id = update.get("update_id")
+        if update_id is None:
+            future.set_result(False)
+            return future
+        if not self._started:
+            self.start()
+        self._queue.put((update_id, json.dumps(update, ensure_ascii=False), time.time(), future))
+        return future
+
+    def done(self, update_id):
+        if update_id is None:
+            return
+        with self._lock:
+            self._done.append(update_id)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    @db_timed
+    def retract(self, update_id):
+        """Удаляет запись апдейта, которому ответили 429: повторная доставка должна записаться заново"""
+        with db_transaction() as c:
+            c.execute(
+                "DELETE FROM update_journal WHERE update_id=? AND owner=? AND done_at IS NULL",
+                (update_id, INSTANCE_ID),
+            )
+
+    def _writer(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=JOURNAL_FLUSH_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < JOURNAL_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                done, self._done = self._done, []
+            if not batch and not done:
+                continue
+            try:
+                inserted = self._commit(batch, done)
+            except Exception as e:
+                print("update journal write error", e)
+                with self._lock:
+                    self._done.extend(done)
+                for *_, future in batch:
+                    future.set_exception(e)
+                continue
+            for (*_, future), ok in zip(batch, inserted):
+                future.set_result(ok)
+
+    @db_timed
+    def _commit(self, batch, done):
+        now = time.time()
+        inserted = []
+        with db_transaction() as c:
+            for update_id, payload, received_at, _ in batch:
+                c.execute(
+                    "INSERT OR IGNORE INTO update_journal (update_id, payload, owner, received_at) VALUES (?,?,?,?)",
+                    (update_id, payload, INSTANCE_ID, received_at),
+                )
+                inserted.append(c.rowcount == 1)
+            c.executemany(
+                "UPDATE update_journal SET done_at=?, payload='' WHERE update_id=?",
+                [(now, update_id) for update_id in done],
+            )
+            if now - self._pruned_at > JOURNAL_PRUNE_INTERVAL:
+                c.execute(
+                    "DELETE FROM update_journal WHERE done_at<?", (now - JOURNAL_KEEP_DONE,)
+                )
+                self._pruned_at = now
+        return inserted
+
+    @db_timed
+    def claim_orphans(self, after_id=0, limit=JOURNAL_BATCH_SIZE):
+        """Забирает себе записи процессов, чья аренда instance:* истекла (курсор по update_id)"""
+        now = time.time()
+        with db_transaction() as c:
+            c.execute("DELETE FROM leases WHERE name LIKE 'instance:%' AND expires_at<?", (now,))
+            rows = c.execute(
+                "SELECT update_id, payload FROM update_journal WHERE update_id>? AND done_at IS NULL AND NOT EXISTS (SELECT 1 FROM leases WHERE name='instance:' || update_journal.owner AND expires_at>?) ORDER BY update_id LIMIT ?",
+                (after_id, now, limit),
+            ).fetchall()
+            c.executemany(
+                "UPDATE update_journal SET owner=? WHERE update_id=?",
+                [(INSTANCE_ID, row[0]) for row in rows],
+            )
+        return rows
+
+    def recover(self):
+        """Переигрывает апдейты, которые приняли, но не успели обработать"""
+        total = 0
+        cursor = 0
+        while True:
+            rows = self.claim_orphans(cursor)
+            if rows:
+                cursor = rows[-1][0]
+            for update_id, payload in rows:
+                update_dedup.accept(update_id)
+                dispatcher.submit(json.loads(payload), block=True)
+            total += len(rows)
+            if len(rows) < JOURNAL_BATCH_SIZE:
+                return total
+
+update_journal = UpdateJournal()
+
+def journal_recovery_loop():
+    while True:
+        jobs_lease.wait()
+        try:
+            replayed = update_journal.recover()
+            if replayed:
+                print(f"♻️ Replayed {replayed} journaled updates")
+        except Exception as e:
+            print("journal recovery error", e)
+        time.sleep(LEASE_TTL)
 
 # -------------------- Webhook --------------------
 @app.route("/", methods=["GET"])
@@ -552,11 +2783,101 @@ def index():
 def webhook():
     try:
         update = request.get_json(force=True)
-        threading.Thread(target=handle_update, args=(update,), daemon=True).start()
+        update_id = update.get("update_id")
+        if not update_dedup.accept(update_id):
+            return jsonify({"ok": True})
+        # Отвечаем Telegram только после того, как апдейт записан в журнал
+        try:
+            fresh = update_journal.append(update).result(timeout=JOURNAL_COMMIT_TIMEOUT)
+        except Exception as e:
+            print("update journal append failed", e)
+            update_dedup.forget(update_id)
+            return jsonify({"ok": False}), 503
+        if not fresh and update_id is not None:
+            # Уже принят этим или другим воркером
+            update_dedup.count_duplicate()
+            return jsonify({"ok": True})
+        if not dispatcher.submit(update):
+            if UPDATE_OVERLOAD == "shed":
+                print("dispatcher overloaded, update dropped")
+                update_journal.done(update_id)
+            else:
+                # Telegram повторит доставку, когда очередь разгрузится
+                try:
+                    update_journal.retract(update_id)
+                except sqlite3.Error as e:
+                    # Запись осталась за нами: повтор её не перезапишет, обработать должны сами
+                    print(f"update {update_id} retract failed, waiting for the queue:", e)
+                    dispatcher.submit(update, block=True)
+                    return jsonify({"ok": True})
+                update_dedup.forget(update_id)
+                return jsonify({"ok": False}), 429
     except Exception as e:
         print("webhook exception", e)
     return jsonify({"ok": True})
 
+@app.route("/cryptobot/webhook", methods=["POST"])
+def cryptobot_webhook():
+    body = request.get_data()
+    if not verify_cryptobot_signature(
+        body, request.headers.get("crypto-pay-api-signature", "")
+    ):
+        return jsonify({"ok": False}), 401
+    try:
+        event = request.get_json(force=True)
+        if event.get("update_type") == "invoice_paid":
+            inv_id = event.get("payload", {}).get("invoice_id")
+            claimed = claim_crypto_invoice(inv_id)
+            if claimed:
+                crypto_confirm_pool.submit(confirm_crypto_payment, inv_id, *claimed)
+            else:
+                print(f"CryptoBot webhook: invoice {inv_id} is not pending")
+    except Exception as e:
+        print("cryptobot webhook exception", e)
+        # Инвойс остался pending: CryptoBot повторит уведомление, сверка тоже его подберёт
+        return jsonify({"ok": False}), 500
+    return jsonify({"ok": True})
+
+ALLOWED_UPDATES = [
+    "message",
+    "callback_query",
+    "pre_checkout_query",
+    "successful_payment",
+]
+
+# -------------------- Metrics endpoint --------------------
+register_metric(Gauge(
+    "bot_updates_in_flight", "Updates being handled by workers right now", lambda: dispatcher.in_flight
+))
+register_metric(Gauge(
+    "bot_duplicate_updates", "Redelivered updates dropped before dispatch", lambda: update_dedup.duplicates
+))
+register_metric(Gauge(
+    "bot_update_journal_queue", "Updates waiting for the journal commit", lambda: update_journal.depth()
+))
+register_metric(Gauge(
+    "bot_update_queue_depth", "Updates waiting in dispatcher queues", lambda: dispatcher.depth()
+))
+register_metric(Gauge(
+    "bot_outbound_queue", "Telegram send queue by kind", lambda: outbound.depth(), ("kind",)
+))
+register_metric(Gauge(
+    "bot_pending_invoices", "Crypto invoices waiting for payment", lambda: count_pending_invoices()
+))
+register_metric(Gauge(
+    "bot_invite_pool", "Pre-created invite links ready to hand out", lambda: count_pooled_invite_links()
+))
+register_metric(Gauge(
+    "bot_price_age_seconds", "Age of the crypto price snapshot", lambda: round(price_feed.snapshot.age(), 1)
+))
+register_metric(Gauge(
+    "bot_user_cache", "User state cache hits, misses and size", lambda: user_cache.stats(), ("stat",)
+))
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
 def set_webhook():
     if not SELF_URL:
         return
@@ -565,20 +2886,122 @@ def set_webhook():
         "setWebhook",
         {
             "url": webhook_url,
-            "allowed_updates": [
-                "message",
-                "callback_query",
-                "pre_checkout_query",
-                "successful_payment",
-            ],
+            "allowed_updates": ALLOWED_UPDATES,
         },
     )
     print("setWebhook response:", res)
 
+# -------------------- Polling --------------------
+def process_update_batch(updates):
+    """Журналирует пачку одним коммитом и ставит в очередь.
+    False — журнал недоступен, offset двигать нельзя."""
+    fresh = [u for u in updates if update_dedup.accept(u.get("update_id"))]
+    futures = [update_journal.append(u) for u in fresh]
+    try:
+        written = [future.result(timeout=JOURNAL_COMMIT_TIMEOUT) for future in futures]
+    except Exception as e:
+        print("update journal append failed", e)
+        for u in fresh:
+            update_dedup.forget(u.get("update_id"))
+        return False
+    # Ждём места в очереди: в режиме polling Telegram не повторит отброшенный апдейт
+    for update, ok in zip(fresh, written):
+        # False — апдейт уже есть в журнале: его обработает (или обработал) тот, кто записал
+        if ok or update.get("update_id") is None:
+            dispatcher.submit(update, block=True)
+    return True
+
+def polling_loop():
+    """Long polling через getUpdates. Offset хранится в bot_state,
+    поэтому после рестарта бот продолжает с последнего принятого апдейта."""
+    offset = None
+    while True:
+        # getUpdates допускает только одного потребителя — опрашивает лидер
+        if not jobs_lease.held():
+            offset = None
+            jobs_lease.wait()
+        try:
+            offset = poll_updates(offset)
+        except Exception as e:
+            # Поток должен пережить ошибку: иначе аренда продлевается, а апдейты никто не забирает
+            print("polling error:", e)
+            offset = None
+            time.sleep(3)
+
+def poll_updates(offset):
+    """Один getUpdates. Возвращает offset для следующего запроса."""
+    if offset is None:
+        res = tg_post("deleteWebhook", {"drop_pending_updates": False})
+        print("deleteWebhook response:", res)
+        offset = int(get_state("polling_offset", "0"))
+    res = tg_post(
+        "getUpdates",
+        {
+            "offset": offset,
+            "limit": POLL_LIMIT,
+            "timeout": POLL_TIMEOUT,
+            "allowed_updates": ALLOWED_UPDATES,
+        },
+        timeout=POLL_TIMEOUT + 10,
+    )
+    if not res or not res.get("ok"):
+        print("getUpdates error:", res)
+        time.sleep(3)
+        return offset
+    updates = res["result"]
+    if not updates:
+        return offset
+    if not process_update_batch(updates):
+        time.sleep(3)
+        return offset
+    set_state("polling_offset", updates[-1]["update_id"] + 1)
+    return updates[-1]["update_id"] + 1
+
 # -------------------- Startup --------------------
-if __name__ == "__main__":
-    set_webhook()
+_services_lock = threading.Lock()
+_services_started = False
+
+def start_services(mode=BOT_MODE):
+    """Запускает воркеры и фоновые циклы. Вызывается один раз в каждом процессе:
+    из __main__ или из post_worker_init в gunicorn.conf.py."""
+    global _services_started
+    with _services_lock:
+        if _services_started:
+            return
+        _services_started = True
+    print(f"Starting services on {INSTANCE_ID} ({mode})")
+    dispatcher.start()
+    outbound.start()
+    update_journal.start()
+    instance_lease.renew()
+    threading.Thread(target=instance_lease.loop, daemon=True).start()
+    jobs_lease.renew()
+    threading.Thread(target=jobs_lease.loop, daemon=True).start()
+    threading.Thread(target=journal_recovery_loop, daemon=True).start()
+    threading.Thread(target=profile_sync.loop, daemon=True).start()
+    threading.Thread(target=user_cache_sync.loop, daemon=True).start()
+    threading.Thread(target=update_dedup.loop, daemon=True).start()
+    if mode == "polling":
+        threading.Thread(target=polling_loop, daemon=True).start()
+    else:
+        set_webhook()
+    threading.Thread(target=broadcast_watchdog_loop, daemon=True).start()
     threading.Thread(target=crypto_checker_loop, daemon=True).start()
     threading.Thread(target=update_crypto_prices_loop, daemon=True).start()
-    print(f"Starting Flask on 0.0.0.0:{PORT}")
-    app.run(host="0.0.0.0", port=PORT)
+    threading.Thread(target=subscription_expiry_loop, daemon=True).start()
+    threading.Thread(target=invite_pool_loop, daemon=True).start()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["webhook", "polling"], default=BOT_MODE)
+    parser.add_argument(
+        "--backfill-stats", action="store_true", help="пересчитать статистику по истории и выйти"
+    )
+    args = parser.parse_args()
+    if args.backfill_stats:
+        rebuild_stats()
+        print("📊 Stats rebuilt")
+    else:
+        start_services(args.mode)
+        print(f"Starting Flask on 0.0.0.0:{PORT}")
+        app.run(host="0.0.0.0", port=PORT)
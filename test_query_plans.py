@@ -0,0 +1,12 @@
+"""Горячие запросы не должны сканировать таблицы (EXPLAIN QUERY PLAN)."""
+import os
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "test")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bot-test-"), "test.db")
+
+import main  # noqa: E402  миграции применяются при импорте
+
+
+def test_hot_queries_use_indexes():
+    assert main.check_query_plans() == []